@@ -170,7 +170,7 @@ main() {
         depends=(protobuf grpc thrift python-nnpy pi bmv2 ebpf-depends p4c ptf
                  yapf boost pcapplusplus)
         non_local_depends=(python-psutil python-pypcap python-graphviz
-                           python-pypacker mininet)
+                           python-pypacker python-numpy mininet)
 
         paru -S --asdeps --needed --noconfirm "${non_local_depends[@]}" "$@"
         non_local_depends=()
@@ -195,7 +195,7 @@ main() {
                  python3-graphviz) # TODO: Add boost, pcapplusplus
         ebpf_depends=(libbpf-dev clang llvm libpcap-dev libelf-dev iproute2
                       net-tools python3-pyroute2 python3-ply python3-scapy)
-        python_depends=(psutil pypcap pypacker)
+        python_depends=(psutil pypcap pypacker numpy)
         non_local_depends=()
 
         sudo apt update -y -qq
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from collections import defaultdict, deque
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.dfa import DFA
+from src.regex import Regex
+from src.topology import Topology
+
+
+def fat_tree_network(k):
+    """
+    Build the network dict of a k-ary fat-tree, as exported by Network in
+    network.json, without starting mininet. The switches and links are numbered
+    in the same way as in 02.fat-tree/run_network.py.
+    """
+    network = {'hosts': {}, 'switches': {}, 'groups': {}, 'links': []}
+
+    def add_intf(node, port):
+        dev_type = 'hosts' if node in network['hosts'] else 'switches'
+        intf = '{}-eth{}'.format(node, port)
+        network[dev_type][node]['intfs'][intf] = {'name': intf, 'port': port}
+        return intf
+
+    def set_neighbor(node, intf, neighbor, neighbor_port):
+        dev_type = 'hosts' if node in network['hosts'] else 'switches'
+        network[dev_type][node]['intfs'][intf]['neighborNode'] = neighbor
+        network[dev_type][node]['intfs'][intf]['neighborPort'] = neighbor_port
+
+    def add_link(node1, node2, port1, port2=0):
+        intf1 = add_intf(node1, port1)
+        intf2 = add_intf(node2, port2)
+        network['links'].append({
+            'node1': node1,
+            'node2': node2,
+            'port1': port1,
+            'port2': port2,
+            'intf1': intf1,
+            'intf2': intf2
+        })
+        set_neighbor(node1, intf1, node2, port2)
+        set_neighbor(node2, intf2, node1, port1)
+        if node2 in network['hosts']:
+            network['switches'][node1]['host_ports'].append(port1)
+
+    for h in range(1, 1 + k**3 // 4):
+        name = 'h{}'.format(h)
+        network['hosts'][name] = {'name': name, 'host_id': h, 'intfs': {}}
+    for s in range(1, 1 + (k // 2)**2 + k**2):
+        name = 's{}'.format(s)
+        network['switches'][name] = {
+            'name': name,
+            'device_id': s - 1,
+            'host_ports': [],
+            'intfs': {}
+        }
+
+    index = 1
+    core_switches = range(index, index + (k // 2)**2)
+    index += len(core_switches)
+    aggr_switches = range(index, index + k**2 // 2)
+    index += len(aggr_switches)
+    edge_switches = range(index, index + k**2 // 2)
+    for i, core in enumerate(core_switches):
+        for j in range(0, k):
+            aggr = aggr_switches[j * (k // 2) + i // (k // 2)]
+            add_link('s{}'.format(core), 's{}'.format(aggr), j + 1,
+                     i % (k // 2) + 1)
+    for i, aggr in enumerate(aggr_switches):
+        for j in range(0, k // 2):
+            edge = edge_switches[(i - i % (k // 2)) + j]
+            add_link('s{}'.format(aggr), 's{}'.format(edge), j + k // 2 + 1,
+                     i % (k // 2) + 1)
+    for i, edge in enumerate(edge_switches):
+        for j in range(0, k // 2):
+            host = i * (k // 2) + j + 1
+            add_link('s{}'.format(edge), 'h{}'.format(host), j + k // 2 + 1)
+    network['groups']['core'] = ['s{}'.format(s) for s in core_switches]
+
+    return network, list(edge_switches)
+
+
+def benchmark_patterns(k, edge_switches):
+    first_edge = 's{}'.format(edge_switches[0])
+    last_edge = 's{}'.format(edge_switches[-1])
+    host_port = k // 2 + 1
+    return [
+        '.*',
+        '{}p{} .* {}p{}'.format(first_edge, host_port, last_edge, host_port),
+        '.* {}p1 .*'.format(first_edge),
+        '{}p{} (.* {}p1 .*)*'.format(first_edge, host_port, last_edge),
+        '{}p{} ({}p1 | {}p2)* {}p{}'.format(first_edge, host_port, first_edge,
+                                            first_edge, first_edge, host_port),
+        # Accepting states that minimization must keep apart
+        's1p4 (.* s2p1 .*)*',
+        '.* s1p2 s4p1 .*',
+    ]
+
+
+def construct_dfa(ast):
+    # Only the construction from the regex AST, without the optimizations and
+    # the transition diagram exports of DFA.__init__
+    dfa = DFA.__new__(DFA)
+    dfa.states = set()
+    dfa.initial = None
+    dfa.accepting = set()
+    dfa.transitions = defaultdict(dict)
+    dfa._construct(ast)
+    return dfa
+
+
+def minimize_dfa(dfa):
+    # Copy of the constructed DFA, minimized
+    minimized = DFA.__new__(DFA)
+    minimized.name = 'benchmark'
+    minimized.states = set(dfa.states)
+    minimized.initial = dfa.initial
+    minimized.accepting = set(dfa.accepting)
+    minimized.transitions = {
+        state: dict(trans) for state, trans in dfa.transitions.items()
+    }
+    minimized.blocks = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        minimized._minimize()
+    return minimized
+
+
+def same_language(dfa, other):
+    """
+    Whether the DFAs accept the same words: no pair of states reachable on the
+    same word in both (None once a DFA has no transition) differs in acceptance
+    """
+    initial = (dfa.initial, other.initial)
+    visited = set([initial])
+    q = deque([initial])
+    while len(q) > 0:
+        state, other_state = q.popleft()
+        if ((state in dfa.accepting) != (other_state in other.accepting)):
+            return False
+        trans = dfa.transitions.get(state, {})
+        other_trans = other.transitions.get(other_state, {})
+        for input_ in trans.keys() | other_trans.keys():
+            pair = (trans.get(input_), other_trans.get(input_))
+            if pair not in visited:
+                visited.add(pair)
+                q.append(pair)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the regex-to-DFA construction')
+    parser.add_argument('-k',
+                        '--arity',
+                        help='Fat-tree arity',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=8)
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Number of runs per pattern',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=3)
+    args = parser.parse_args()
+
+    network, edge_switches = fat_tree_network(args.arity)
+    topo = Topology(network)
+    print('Fat-tree k={}: {} switches, {} symbols'.format(
+        args.arity, len(topo.switches), len(topo.symbols)))
+
+    for pattern in benchmark_patterns(args.arity, edge_switches):
+        tokens = Regex.preprocessor(pattern, topo.macros)
+        ast = Regex.parser(tokens, topo.alphabet, topo.drop_alph)
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            dfa = construct_dfa(ast)
+            end = time.perf_counter()
+            best = end - start if best is None else min(best, end - start)
+        minimized = minimize_dfa(dfa)
+        if not same_language(dfa, minimized):
+            raise Exception('Minimization changes the language of ' + pattern)
+        print('{:<40} {:>6} states {:>6} minimized {:>10.4f} seconds'.format(
+            pattern, len(dfa.states), len(minimized.states), best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from src.pec import pec_calc, pec_sweep, pec_regions, pec_vectorized
+
+
+def random_ranges(num_invariants, seed):
+    """
+    Source and destination IPv4 ranges of random invariants, as for pec_calc.
+    Most ranges are subnets of 10.0.0.0/16, so that they overlap.
+    """
+    rng = random.Random(seed)
+    base = 10 << 24
+
+    def ip_range():
+        prefix_len = rng.randint(20, 28)
+        size = 1 << (32 - prefix_len)
+        low = base + rng.randrange(0, 1 << 16, size)
+        return (low, low + size - 1)
+
+    return [[ip_range(), ip_range()] for _ in range(num_invariants)]
+
+
+def best_time(func, ranges, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(ranges)
+        end = time.perf_counter()
+        best = end - start if best is None else min(best, end - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the PEC computations')
+    parser.add_argument('-n',
+                        '--invariants',
+                        help='Numbers of invariants',
+                        type=int,
+                        nargs='+',
+                        required=False,
+                        default=[10, 20, 40, 80, 160, 320])
+    parser.add_argument('--max-calc',
+                        help='Largest number of invariants for pec_calc',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=80)
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Number of runs per function',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=3)
+    parser.add_argument('-s',
+                        '--seed',
+                        help='Random seed',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=1)
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>12} {:>12} {:>12} {:>14}'.format(
+        'invariants', 'PECs', 'pec_calc', 'pec_sweep', 'pec_regions',
+        'pec_vectorized'))
+    for num_invariants in args.invariants:
+        ranges = random_ranges(num_invariants, args.seed)
+        pecs, sweep_time = best_time(pec_sweep, ranges, args.repeat)
+        regions, regions_time = best_time(pec_regions, ranges, args.repeat)
+        assert set(regions.keys()) == pecs
+        vectorized_pecs, vectorized_time = best_time(pec_vectorized, ranges,
+                                                     args.repeat)
+        assert vectorized_pecs == pecs
+        calc_time = '-'
+        if num_invariants <= args.max_calc:
+            calc_pecs, seconds = best_time(pec_calc, ranges, 1)
+            assert calc_pecs == pecs
+            calc_time = '{:.4f}'.format(seconds)
+        print('{:>10} {:>8} {:>12} {:>12.4f} {:>12.4f} {:>14.4f}'.format(
+            num_invariants, len(pecs), calc_time, sweep_time, regions_time,
+            vectorized_time))
+
+
+if __name__ == '__main__':
+    main()
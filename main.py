@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+from src.constants import INSTALL_WORKERS
+from src.constants import VIOLATION_WINDOW, VIOLATION_RATE
 from src.controller import Controller
+from src.violations import JsonLinesSink
+from src.p4runtime_lib.switch import WRITE_BATCH_SIZE
+from src.p4runtime_lib.switch import LOG_MODES, LOG_TEXT
 
 
 def main():
@@ -31,13 +36,109 @@ def main():
                         action='store',
                         required=False,
                         default='build/switch.json')
+    parser.add_argument('--batch-size',
+                        help='number of updates per P4Runtime write request',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=WRITE_BATCH_SIZE)
+    parser.add_argument('--install-workers',
+                        help='number of switches to install rules concurrently',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=INSTALL_WORKERS)
+    parser.add_argument('--compile-workers',
+                        help='number of processes to compile invariants '
+                        '(default: number of CPUs)',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=None)
+    parser.add_argument('--dfa-cache',
+                        help='directory of the compiled DFA cache',
+                        type=str,
+                        action='store',
+                        required=False,
+                        default='build/dfa-cache')
+    parser.add_argument('--p4runtime-log',
+                        help='P4Runtime request log mode',
+                        type=str,
+                        action='store',
+                        required=False,
+                        choices=LOG_MODES,
+                        default=LOG_TEXT)
+    parser.add_argument('--p4runtime-log-sample',
+                        help='log one in every N P4Runtime requests',
+                        type=int,
+                        action='store',
+                        required=False,
+                        default=1)
+    parser.add_argument('--violation-log',
+                        help='file to append the violation reports to, as '
+                        'JSON lines',
+                        type=str,
+                        action='store',
+                        required=False,
+                        default=None)
+    parser.add_argument('--no-print-violations',
+                        help='do not print the violation reports',
+                        action='store_true')
+    parser.add_argument('--violation-details',
+                        help='print the decoded packets of the violations',
+                        action='store_true')
+    parser.add_argument('--violation-window',
+                        help='number of seconds over which repeated '
+                        'violations of a flow are aggregated',
+                        type=float,
+                        action='store',
+                        required=False,
+                        default=VIOLATION_WINDOW)
+    parser.add_argument('--violation-rate',
+                        help='maximum number of violation reports per second '
+                        'per invariant',
+                        type=float,
+                        action='store',
+                        required=False,
+                        default=VIOLATION_RATE)
+    parser.add_argument('--reconcile',
+                        help='only update the rules that differ from those on '
+                        'the switches, and keep an unchanged P4 program',
+                        action='store_true')
+    parser.add_argument('--watch-invariants',
+                        help='apply the changes of the invariants file while '
+                        'running',
+                        action='store_true')
+    parser.add_argument('--watch-network',
+                        help='apply the changes of the network file (e.g., '
+                        'links going down or up) to the verification rules '
+                        'while running',
+                        action='store_true')
     args = parser.parse_args()
 
+    violation_sinks = []
+    if args.violation_log != None:
+        violation_sinks.append(JsonLinesSink(args.violation_log))
+
     # Start the controller
     controller = Controller(network_json=args.network,
                             inv_json=args.invariants,
                             p4info_path=args.p4info,
-                            bmv2_json=args.bmv2_json)
+                            bmv2_json=args.bmv2_json,
+                            batch_size=args.batch_size,
+                            install_workers=args.install_workers,
+                            compile_workers=args.compile_workers,
+                            dfa_cache_dir=args.dfa_cache,
+                            log_mode=args.p4runtime_log,
+                            log_sample_every=args.p4runtime_log_sample,
+                            violation_sinks=violation_sinks,
+                            print_violations=not args.no_print_violations,
+                            violation_details=args.violation_details,
+                            violation_window=args.violation_window,
+                            violation_rate=args.violation_rate,
+                            reconcile=args.reconcile,
+                            watch_invariants=args.watch_invariants,
+                            watch_network=args.watch_network)
     controller.start()
 
 
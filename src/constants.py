@@ -15,6 +15,27 @@ TRACE_LENGTH = 8
 # Number of seconds to wait for a switch to start
 SWITCH_START_TIMEOUT = 10
 
+# Maximum number of switches to install P4 programs and rules at the same time
+INSTALL_WORKERS = 16
+
+# Number of seconds over which repeated violations of a flow are aggregated
+VIOLATION_WINDOW = 1.0
+
+# Maximum number of violation reports per second per invariant
+VIOLATION_RATE = 10
+
+# Maximum number of flows aggregated in a violation window
+VIOLATION_MAX_FLOWS = 65536
+
+# Number of latest violation reports kept in memory by the controller
+VIOLATION_RING_SIZE = 1024
+
+# Number of seconds between checks of the invariants file for changes
+INVARIANTS_WATCH_INTERVAL = 1.0
+
+# Number of seconds between checks of the network file for changes
+NETWORK_WATCH_INTERVAL = 1.0
+
 
 # Priority for match-action table entries
 @unique
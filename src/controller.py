@@ -1,43 +1,127 @@
 #!/usr/bin/env python3
 
+import os
 import grpc
 import json
 import time
 import asyncio
+import hashlib
 from collections import defaultdict
-from pypacker.layer12 import ethernet
-from pypacker.layer3 import ip, icmp
+from concurrent.futures import ThreadPoolExecutor
+from google.rpc import code_pb2
+from p4.v1 import p4runtime_pb2
+from p4.config.v1 import p4info_pb2
 
+from .p4runtime_lib.aioswitch import AioSwitchConnection
 from .p4runtime_lib.bmv2 import Bmv2SwitchConnection
 from .p4runtime_lib.helper import P4InfoHelper
 from .p4runtime_lib.error_utils import printGrpcError
 from .p4runtime_lib.switch import ShutdownAllSwitchConnections
+from .p4runtime_lib.switch import WRITE_BATCH_SIZE
+from .p4runtime_lib.switch import LOG_TEXT, LOG_BINARY
+from .p4runtime_lib.template import TableEntryEncoder
 from .constants import *
+from .dfacache import DFACache
 from .invariants import *
 from .network import run_mnexc_cmd
+from .packetset import PacketSet, FULL_RANGES
+from .pec import pec_regions
+from .reconcile import RuleKeys, diff_rules
+from .topology import Topology
+from .violations import *
+
+# Owner of the encapsulation and decapsulation rules among the invariants whose
+# installed rules are tracked by the controller
+ENCAP_DECAP = 'encap_decap'
 
 
 class Controller:
 
-    def __init__(self, network_json, inv_json, p4info_path, bmv2_json):
+    def __init__(self,
+                 network_json,
+                 inv_json,
+                 p4info_path,
+                 bmv2_json,
+                 batch_size=WRITE_BATCH_SIZE,
+                 install_workers=INSTALL_WORKERS,
+                 compile_workers=None,
+                 dfa_cache_dir=None,
+                 log_mode=LOG_TEXT,
+                 log_sample_every=1,
+                 violation_sinks=None,
+                 print_violations=True,
+                 violation_details=False,
+                 violation_window=VIOLATION_WINDOW,
+                 violation_rate=VIOLATION_RATE,
+                 reconcile=False,
+                 watch_invariants=False,
+                 watch_network=False):
         # Load the network
+        self.network_json = network_json
+        self.watch_network = watch_network # see watch_network_file
         self.network = {}
         with open(network_json, 'r') as infile:
             self.network = json.load(infile)
-
-        # Load the invariants
-        self.invariants = InvariantsParser.parse(inv_json)
-
-        # TODO: Calculate the invariant-wide equivalent packet sets
-        self.ps_to_invs = dict() # PacketSet -> [ Invariants ]
+        self.topology = Topology(self.network)
+
+        # Load the invariants (invariant ID -> Invariant). The IDs of removed
+        # invariants are not reused.
+        self.inv_json = inv_json
+        self.invariants = {
+            invariant.id: invariant
+            for invariant in InvariantsParser.parse(inv_json)
+        }
+        self.next_inv_id = len(self.invariants)
+        self.watch_invariants = watch_invariants # see watch_invariants_file
+        self.update_lock = None # see _run_update
+
+        # Installed verification rules, deduplicated across their owners (the
+        # invariant IDs and ENCAP_DECAP) by their keys (see RuleKeys): switch ->
+        # rule key -> { owner -> rule }. Each entry is installed with the rule
+        # of its first owner and deleted with its last one.
+        self.installed_inv_rules = defaultdict(dict)
+        self.inv_rule_keys = dict() # owner -> switch -> { rule key }
+
+        # Persistent cache of the compiled DFAs (disabled if no directory)
+        self.dfa_cache = None
+        if dfa_cache_dir != None:
+            self.dfa_cache = DFACache(dfa_cache_dir)
+
+        # Invariant-wide equivalent packet sets (see
+        # _packet_equivalence_classes)
+        self.ps_to_invs = self._packet_equivalence_classes()
+        # TODO: Calculate the DFAs of the equivalent packet sets
         self.ps_to_dfas = dict() # PacketSet -> DFA
 
         # Switch connections
         self.sw_conns = {}
+        self.stream_conns = {} # asyncio stream channels (see async_connect)
         self.p4info_helper = P4InfoHelper(p4info_path)
+        self.entry_encoder = TableEntryEncoder(self.p4info_helper)
+        self.rule_keys = RuleKeys(self.p4info_helper)
+        self.range_encoder = RangeEncoder(self._packet_set_match_kinds())
+        self.rule_merger = RuleMerger(self.rule_keys, self.range_encoder)
         self.bmv2_json = bmv2_json
+        self.pipeline_cookie = self._pipeline_cookie()
+        # Whether to update the switches from their current state instead of
+        # installing everything from scratch (see reconcile)
+        self.reconcile_mode = reconcile
+        self.batch_size = batch_size # updates per P4Runtime WriteRequest
+        self.install_workers = install_workers # switches installed at once
+        self.compile_workers = compile_workers # None: number of CPUs
+        self.log_mode = log_mode # P4Runtime request log mode
+        self.log_sample_every = log_sample_every # log one in N requests
         self.futures = []
 
+        # Violation reports: the latest ones are always kept in memory
+        self.recent_violations = RingBufferSink()
+        sinks = [self.recent_violations] + list(violation_sinks or [])
+        if print_violations:
+            sinks.append(PrintSink(self.invariants, violation_details))
+        self.violations = ViolationPipeline(sinks,
+                                            window=violation_window,
+                                            rate=violation_rate)
+
     def set_reduced_MTU(self):
         if len(self.invariants) > 0:
             for host_dict in self.network['hosts'].values():
@@ -46,93 +130,224 @@ class Controller:
                     cmd = 'ip link set dev {} mtu 1497'.format(intf)
                     run_mnexc_cmd(host_dict['pid'], cmd)
 
-    def connect(self):
+    def connect(self, log_modes=None, stream=True):
+        # log_modes: switch name -> request log mode, overriding self.log_mode
+        # stream: whether the connections open the stream channel and become
+        # master (otherwise, see async_connect)
+        log_modes = log_modes or {}
         for sw in self.network['switches'].values():
-            p4rt_logs = 'logs/{}-p4runtime-requests.txt'.format(sw['name'])
-            sw_conn = Bmv2SwitchConnection(name=sw['name'],
-                                           address='127.0.0.1:{}'.format(
-                                               sw['grpc_port']),
-                                           device_id=sw['device_id'],
-                                           proto_dump_file=p4rt_logs)
+            log_mode = log_modes.get(sw['name'], self.log_mode)
+            p4rt_logs = 'logs/{}-p4runtime-requests.{}'.format(
+                sw['name'], 'bin' if log_mode == LOG_BINARY else 'txt')
+            sw_conn = Bmv2SwitchConnection(
+                name=sw['name'],
+                address='127.0.0.1:{}'.format(sw['grpc_port']),
+                device_id=sw['device_id'],
+                proto_dump_file=p4rt_logs,
+                log_mode=log_mode,
+                log_sample_every=self.log_sample_every,
+                stream=stream)
             self.sw_conns[sw['name']] = sw_conn
 
             # Send master arbitration update message to establish this
             # controller as master (required by P4Runtime before performing any
             # other write operation)
-            sw_conn.MasterArbitrationUpdate()
+            if stream:
+                sw_conn.MasterArbitrationUpdate()
+
+    async def async_connect(self, log_modes=None):
+        # The stream channels are handled by the event loop, and the master
+        # arbitration of all switches is done concurrently. The blocking
+        # connections are kept for the other RPCs, with the same election ID.
+
+        async def _connect(sw):
+            address = '127.0.0.1:{}'.format(sw['grpc_port'])
+            stream_conn = AioSwitchConnection(name=sw['name'],
+                                              address=address,
+                                              device_id=sw['device_id'])
+            await stream_conn.MasterArbitrationUpdate()
+            return stream_conn
+
+        stream_conns = await asyncio.gather(
+            *[_connect(sw) for sw in self.network['switches'].values()])
+        self.stream_conns = {
+            stream_conn.name: stream_conn for stream_conn in stream_conns
+        }
+        self.connect(log_modes, stream=False)
+
+    def _run_on_switches(self, func, sw_names):
+        # Run func(sw_name) for all the given switches concurrently, each of
+        # which has its own gRPC channel. Errors are gathered per switch and
+        # reported after all switches have finished.
+        results = {}
+        failed_switches = []
+        with ThreadPoolExecutor(max_workers=self.install_workers) as executor:
+            futures = {
+                sw_name: executor.submit(func, sw_name) for sw_name in sw_names
+            }
+            for sw_name, future in futures.items():
+                try:
+                    results[sw_name] = future.result()
+                except grpc.RpcError as e:
+                    print('Error at', sw_name, end=': ')
+                    printGrpcError(e)
+                    failed_switches.append(sw_name)
+                except Exception as e:
+                    print('Error at {}: {}'.format(sw_name, e))
+                    failed_switches.append(sw_name)
+        if len(failed_switches) > 0:
+            raise Exception('Failed on {} switches: {}'.format(
+                len(failed_switches), ', '.join(failed_switches)))
+        return results
+
+    def _packet_equivalence_classes(self, invariants=None):
+        # Splits the packet sets of the invariants (by default, the current
+        # ones) into the disjoint boxes of their packet equivalence classes:
+        # PacketSet -> [ Invariants ] whose packet sets contain it. Only the
+        # non-empty classes are computed (see pec_regions), over the fields
+        # that some invariant constrains.
+        if invariants == None:
+            invariants = self.invariants.values()
+        invariants = [
+            invariant for invariant in invariants
+            if not invariant.packet_set.is_empty()
+        ]
+        if len(invariants) == 0:
+            return dict()
+        boxes = [invariant.packet_set.box() for invariant in invariants]
+        dims = [
+            dim for dim, full_range in enumerate(FULL_RANGES)
+            if any(box[dim] != full_range for box in boxes)
+        ] or [0]
+        ranges = [[box[dim] for dim in dims] for box in boxes]
+        ps_to_invs = dict()
+        for pec, regions in pec_regions(ranges).items():
+            pec_invariants = [invariants[j] for j in pec]
+            for region in regions:
+                box = list(FULL_RANGES)
+                for dim, value in zip(dims, region):
+                    box[dim] = value
+                ps_to_invs[PacketSet.from_box(box)] = pec_invariants
+        return ps_to_invs
+
+    def _packet_set_match_kinds(self):
+        # Match kinds of the packet set keys of the tables (see RangeEncoder)
+        match_kinds = dict()
+        for table in self.p4info_helper.p4info.tables:
+            for mf in table.match_fields:
+                if mf.name in RangeEncoder.KEYS:
+                    match_type = p4info_pb2.MatchField.MatchType.Name(
+                        mf.match_type)
+                    match_kinds[(table.preamble.name,
+                                 mf.name)] = match_type.lower()
+        return match_kinds
+
+    def _pipeline_cookie(self):
+        # Identifies the P4 program, so that an unchanged program is not
+        # pushed again to the switches (see reconcile)
+        digest = hashlib.sha256()
+        digest.update(self.p4info_helper.p4info.SerializeToString())
+        with open(self.bmv2_json, 'rb') as infile:
+            digest.update(infile.read())
+        return int.from_bytes(digest.digest()[:8], byteorder='big')
+
+    def _install_P4_program(self, sw_name):
+        sw_conn = self.sw_conns[sw_name]
+        print('Installing P4 program on {}'.format(sw_conn.name))
+        sw_conn.SetForwardingPipelineConfig(p4info=self.p4info_helper.p4info,
+                                            cookie=self.pipeline_cookie,
+                                            bmv2_json_file_path=self.bmv2_json)
 
     def install_P4_programs(self):
-        for sw_conn in self.sw_conns.values():
-            print('Installing P4 program on', sw_conn.name)
-            sw_conn.SetForwardingPipelineConfig(
-                p4info=self.p4info_helper.p4info,
-                bmv2_json_file_path=self.bmv2_json)
+        self._run_on_switches(self._install_P4_program, self.sw_conns.keys())
+
+    def _encode_rule(self, rule):
+        tbl_name = rule['table_name']
+        mfs = rule['match_fields'] if 'match_fields' in rule else None
+        an = rule['action_name'] if 'action_name' in rule else None
+        aps = rule['action_params'] if 'action_params' in rule else None
+        priority = rule['priority'] if 'priority' in rule else None
+        return self.entry_encoder.encodeTableEntry(table_name=tbl_name,
+                                                   match_fields=mfs,
+                                                   action_name=an,
+                                                   action_params=aps,
+                                                   priority=priority)
+
+    def _write_switch_updates(self, sw_name, updates, sources):
+        # updates: (update type, encoded table entry), and sources: the rule
+        # (or the TableEntry read from the switch) of each update
+        errors = self.sw_conns[sw_name].WriteEncodedUpdates(
+            updates, batch_size=self.batch_size)
+        # Map the failed updates back to the source rules
+        for idx, p4_error in errors:
+            update_name = p4runtime_pb2.Update.Type.Name(updates[idx][0])
+            code_name = code_pb2.Code.Name(p4_error.canonical_code)
+            print('Failed to {} rule on {}: {}, \'{}\''.format(
+                update_name.lower(), sw_name, code_name, p4_error.message))
+            if type(sources[idx]) == dict:
+                print(json.dumps(sources[idx], indent=4))
+            else:
+                print(sources[idx])
+        if len(errors) > 0:
+            raise Exception('Failed to write {} rules on {}'.format(
+                len(errors), sw_name))
+
+    def _install_switch_rules(self, sw_name, rules):
+        insert = p4runtime_pb2.Update.INSERT
+        updates = [(insert, self._encode_rule(rule)) for rule in rules]
+        self._write_switch_updates(sw_name, updates, rules)
+        return len(rules)
 
     def install_rules(self, rules_dict):
-        num_rules = 0
-        for sw_name, rules in rules_dict.items():
-            for rule in rules:
-                tbl_name = rule['table_name']
-                mfs = rule['match_fields'] if 'match_fields' in rule else None
-                an = rule['action_name'] if 'action_name' in rule else None
-                aps = rule['action_params'] if 'action_params' in rule else None
-                priority = rule['priority'] if 'priority' in rule else None
-                table_entry = self.p4info_helper.buildTableEntry(
-                    table_name=tbl_name,
-                    match_fields=mfs,
-                    action_name=an,
-                    action_params=aps,
-                    priority=priority)
-                # print(sw_name, json.dumps(rule, indent=4))
-                self.sw_conns[sw_name].WriteTableEntry(table_entry)
-            num_rules += len(rules)
-        return num_rules
-
-    def _install_encap_decap_rules(self):
-        num_rules = 0
-        for sw_name, sw in self.network['switches'].items():
-            # Only install at the border switches
-            if len(sw['host_ports']) == 0:
-                continue
+
+        def _install_rules(sw_name):
+            return self._install_switch_rules(sw_name, rules_dict[sw_name])
+
+        num_rules = self._run_on_switches(_install_rules, rules_dict.keys())
+        return sum(num_rules.values())
+
+    def _encap_decap_rules(self):
+        rules = defaultdict(list)
+        # Only install at the border switches
+        for sw_name in self.topology.border_switches:
+            sw = self.network['switches'][sw_name]
 
             # Install rules for entering the network
-            table_entry = self.p4info_helper.buildTableEntry(
-                table_name='MyIngress.encapsulation',
-                match_fields={
+            rules[sw_name].append({
+                'table_name': 'MyIngress.encapsulation',
+                'match_fields': {
                     'hdr.ipv4.protocol':
                         (PROTO_VERIFICATION, PROTO_VERIFICATION)
                 },
-                action_name='NoAction',
-                priority=Priority.HIGH)
-            self.sw_conns[sw_name].WriteTableEntry(table_entry)
-
-            table_entry = self.p4info_helper.buildTableEntry(
-                table_name='MyIngress.encapsulation',
-                match_fields={},
-                action_name='MyIngress.insert_verification_header',
-                priority=Priority.LOW)
-            self.sw_conns[sw_name].WriteTableEntry(table_entry)
+                'action_name': 'NoAction',
+                'priority': Priority.HIGH
+            })
+            rules[sw_name].append({
+                'table_name': 'MyIngress.encapsulation',
+                'match_fields': {},
+                'action_name': 'MyIngress.insert_verification_header',
+                'priority': Priority.LOW
+            })
 
             # Install rules for leaving the network
             for host_port in sw['host_ports']:
-                table_entry = self.p4info_helper.buildTableEntry(
-                    table_name='MyEgress.check_leaving',
-                    match_fields={
+                rules[sw_name].append({
+                    'table_name': 'MyEgress.check_leaving',
+                    'match_fields': {
                         'std_meta.egress_port': host_port,
                     },
-                    action_name='MyEgress.mark_leaving',
-                )
-                self.sw_conns[sw_name].WriteTableEntry(table_entry)
+                    'action_name': 'MyEgress.mark_leaving'
+                })
 
             # Install rules for removing verification headers
-            table_entry = self.p4info_helper.buildTableEntry(
-                table_name='MyEgress.decapsulation',
-                match_fields={'meta.verification.leaving': 1},
-                action_name='MyEgress.remove_verification_header')
-            self.sw_conns[sw_name].WriteTableEntry(table_entry)
-
-            num_rules += 3 + len(sw['host_ports'])
-        return num_rules
+            rules[sw_name].append({
+                'table_name': 'MyEgress.decapsulation',
+                'match_fields': {
+                    'meta.verification.leaving': 1
+                },
+                'action_name': 'MyEgress.remove_verification_header'
+            })
+        return rules
 
     # def _install_trace_rules(self):
     #     for sw_name, sw in self.network['switches'].items():
@@ -164,43 +379,69 @@ class Controller:
     #             priority=Priority.LOW)
     #         self.sw_conns[sw_name].WriteTableEntry(table_entry)
 
+    def _is_installed(self, sw_name, rule):
+        key = self.rule_keys.rule_key(rule)
+        return key in self.installed_inv_rules[sw_name]
+
+    def _installed_rule(self, sw_name, key):
+        owners = self.installed_inv_rules[sw_name].get(key)
+        if not owners:
+            return None
+        return next(iter(owners.values()))
+
+    def _add_invariant_rules(self, inv_id, rules):
+        # Counts the references of the invariant to its rules' entries
+        rule_keys = self.inv_rule_keys.setdefault(inv_id, dict())
+        for sw_name, rules_list in rules.items():
+            for rule in rules_list:
+                key = self.rule_keys.rule_key(rule)
+                owners = self.installed_inv_rules[sw_name].setdefault(key, {})
+                owners.setdefault(inv_id, rule)
+                rule_keys.setdefault(sw_name, set()).add(key)
+
+    def _remove_invariant_rules(self, inv_id):
+        for sw_name, keys in self.inv_rule_keys.pop(inv_id, {}).items():
+            for key in keys:
+                owners = self.installed_inv_rules[sw_name][key]
+                del owners[inv_id]
+                if len(owners) == 0:
+                    del self.installed_inv_rules[sw_name][key]
+
     def install_verification_rules(self):
         num_rules = 0
 
         if len(self.invariants) > 0:
-            num_rules += self._install_encap_decap_rules()
+            encap_decap_rules = self._encap_decap_rules()
+            num_rules += self.install_rules(encap_decap_rules)
+            self._add_invariant_rules(ENCAP_DECAP, encap_decap_rules)
             # num_rules += self._install_trace_rules() # Disable for now
 
-        installed_inv_rules = defaultdict(set)
-
-        def _is_installed(sw_name, rule):
-            nonlocal installed_inv_rules
-            match_entry = {k: rule[k] for k in ['table_name', 'match_fields']}
-            return (json.dumps(match_entry, sort_keys=True)
-                    in installed_inv_rules[sw_name])
-
-        def _add_installed_rule(sw_name, rule):
-            nonlocal installed_inv_rules
-            match_entry = {k: rule[k] for k in ['table_name', 'match_fields']}
-            installed_inv_rules[sw_name].add(
-                json.dumps(match_entry, sort_keys=True))
-
-        compile_time = 0
         install_time = 0
 
-        for invariant in self.invariants:
+        # Compile the rules of all invariants in parallel
+        invariants = list(self.invariants.values())
+        start = time.perf_counter()
+        compiled = compile_invariants(invariants, self.topology,
+                                      self.compile_workers, self.dfa_cache,
+                                      self.range_encoder)
+        # Share the DFA rules between the invariants with the same DFA
+        inv_rules = self.rule_merger.merge(
+            invariants, self.topology, {
+                invariant.id: rule_parts
+                for invariant, (rule_parts, _) in zip(invariants, compiled)
+            })
+        end = time.perf_counter()
+        total_compile_time = end - start
+
+        for invariant, (_, compile_time) in zip(invariants, compiled):
             print('Installing rules for invariant', invariant.name)
-            # Compile the rules
-            start = time.perf_counter()
-            rules = invariant.get_rules(self.network)
-            end = time.perf_counter()
-            compile_time += end - start
+            print('Compile time:', compile_time, 'seconds')
             # Filter out duplicate rules
             rules = {
                 sw_name: [
                     rule for rule in rules_list
-                    if not _is_installed(sw_name, rule)
-                ] for sw_name, rules_list in rules.items()
+                    if not self._is_installed(sw_name, rule)
+                ] for sw_name, rules_list in inv_rules[invariant.id].items()
             }
             # Install rules
             start = time.perf_counter()
@@ -208,14 +449,372 @@ class Controller:
             end = time.perf_counter()
             install_time += end - start
             # Remember the installed rules
-            for sw_name, rules_list in rules.items():
-                for rule in rules_list:
-                    _add_installed_rule(sw_name, rule)
+            self._add_invariant_rules(invariant.id, inv_rules[invariant.id])
 
         print('Verification rules:', num_rules)
-        print('Compile time:', compile_time, 'seconds')
+        print('Total compile time:', total_compile_time, 'seconds')
         print('Install time:', install_time, 'seconds')
 
+    def reconcile(self):
+        # Brings the switches to the desired state with the fewest updates: the
+        # P4 program is only pushed if it changed (which clears the tables),
+        # and the rules are diffed against the entries read from the switches
+        rules = defaultdict(list)
+        for sw_name, rules_list in self.network['rules'].items():
+            rules[sw_name].extend(rules_list)
+        if len(self.invariants) > 0:
+            self._add_invariant_rules(ENCAP_DECAP, self._encap_decap_rules())
+            invariants = list(self.invariants.values())
+            start = time.perf_counter()
+            compiled = compile_invariants(invariants, self.topology,
+                                          self.compile_workers, self.dfa_cache,
+                                          self.range_encoder)
+            inv_rules = self.rule_merger.merge(
+                invariants, self.topology, {
+                    invariant.id: rule_parts
+                    for invariant, (rule_parts, _) in zip(invariants, compiled)
+                })
+            end = time.perf_counter()
+            print('Total compile time:', end - start, 'seconds')
+            for invariant in invariants:
+                self._add_invariant_rules(invariant.id, inv_rules[invariant.id])
+            for sw_name, installed in self.installed_inv_rules.items():
+                for key in installed.keys():
+                    rules[sw_name].append(self._installed_rule(sw_name, key))
+
+        def _reconcile(sw_name):
+            sw_conn = self.sw_conns[sw_name]
+            table_entries = []
+            if sw_conn.GetForwardingPipelineCookie() != self.pipeline_cookie:
+                self._install_P4_program(sw_name)
+            else:
+                for response in sw_conn.ReadTableEntries():
+                    for entity in response.entities:
+                        table_entries.append(entity.table_entry)
+            inserts, modifies, deletes = diff_rules(self.rule_keys,
+                                                    rules[sw_name],
+                                                    table_entries)
+            updates = []
+            for entry in deletes:
+                updates.append(
+                    (p4runtime_pb2.Update.DELETE, entry.SerializeToString()))
+            for rule in modifies:
+                updates.append(
+                    (p4runtime_pb2.Update.MODIFY, self._encode_rule(rule)))
+            for rule in inserts:
+                updates.append(
+                    (p4runtime_pb2.Update.INSERT, self._encode_rule(rule)))
+            self._write_switch_updates(sw_name, updates,
+                                       deletes + modifies + inserts)
+            return len(inserts), len(modifies), len(deletes)
+
+        start = time.perf_counter()
+        results = self._run_on_switches(_reconcile, self.sw_conns.keys())
+        end = time.perf_counter()
+        num_updates = [0, 0, 0]
+        for counts in results.values():
+            num_updates = [n + count for n, count in zip(num_updates, counts)]
+        print('Reconciled rules: {} inserted, {} modified, {} deleted'.format(
+            *num_updates))
+        print('Reconcile time:', end - start, 'seconds')
+
+    def update_invariants(self, added_specs=(), removed_ids=()):
+        """
+        Adds and removes invariants on the running switches. Only the added
+        invariants are compiled, and only the entries whose installed rules
+        change are written. Returns the IDs of the added invariants.
+        """
+        added = self._build_invariants(added_specs, removed_ids)
+        apply = self._compile_invariants_update(added, removed_ids)
+        self._install_update(*apply())
+        return [invariant.id for invariant in added]
+
+    def _build_invariants(self, added_specs, removed_ids):
+        # Checks the removed IDs, and builds the added invariants with new IDs
+        for inv_id in removed_ids:
+            if inv_id not in self.invariants:
+                raise Exception('Unknown invariant {}'.format(inv_id))
+        added = []
+        for inv_spec in added_specs:
+            added.append(InvariantsParser.build(self.next_inv_id, inv_spec))
+            self.next_inv_id += 1
+        return added
+
+    def _compile_invariants_update(self, added, removed_ids):
+        """
+        Compiles the rules of an update of the invariants, without changing the
+        invariants and the installed rules, so that it can run off the event
+        loop (see _run_update). Returns the function that applies it, which
+        returns the entry updates and the summary (see _install_update).
+        """
+        invariants = dict(self.invariants)
+        for invariant in added:
+            invariants[invariant.id] = invariant
+        for inv_id in removed_ids:
+            del invariants[inv_id]
+
+        start = time.perf_counter()
+        compiled = compile_invariants(added, self.topology,
+                                      self.compile_workers, self.dfa_cache,
+                                      self.range_encoder)
+        compiled_parts = {
+            invariant.id: rule_parts
+            for invariant, (rule_parts, _) in zip(added, compiled)
+        }
+        # The DFA groups of the added and removed invariants change, so do the
+        # rules of the other invariants in them
+        added_rules = self.rule_merger.merge(invariants.values(), self.topology,
+                                             compiled_parts)
+        end = time.perf_counter()
+        print('Compile time:', end - start, 'seconds')
+
+        ps_to_invs = self._packet_equivalence_classes(invariants.values())
+        removed_owners = list(removed_ids)
+        for inv_id in added_rules.keys():
+            if inv_id not in compiled_parts:
+                removed_owners.append(inv_id)
+        # The encapsulation and decapsulation rules are needed as long as
+        # there are invariants
+        if len(invariants) == 0:
+            removed_owners.append(ENCAP_DECAP)
+        elif ENCAP_DECAP not in self.inv_rule_keys:
+            added_rules[ENCAP_DECAP] = self._encap_decap_rules()
+
+        def apply():
+            # The invariants are changed in place, as the violation sinks
+            # share them
+            for invariant in added:
+                self.invariants[invariant.id] = invariant
+            for inv_id in removed_ids:
+                del self.invariants[inv_id]
+            self.ps_to_invs = ps_to_invs
+            updates = self._apply_rules(removed_owners, added_rules)
+            summary = 'Invariants: {} added, {} removed'.format(
+                len(added), len(removed_ids))
+            return updates, summary
+
+        return apply
+
+    def _apply_rules(self, removed_owners, added_rules):
+        """
+        Replaces the rules of the removed owners by the added rules (owner ->
+        switch -> rules) in the installed rules. Returns the updates of the
+        entries whose installed rules change: switch -> [ (update type, rule) ]
+        """
+        # The entries whose installed rules may change
+        touched = set()
+        for owner in removed_owners:
+            for sw_name, keys in self.inv_rule_keys.get(owner, {}).items():
+                touched.update((sw_name, key) for key in keys)
+        for rules in added_rules.values():
+            for sw_name, rules_list in rules.items():
+                touched.update((sw_name, self.rule_keys.rule_key(rule))
+                               for rule in rules_list)
+        before = {
+            (sw_name, key): self._installed_rule(sw_name, key)
+            for sw_name, key in touched
+        }
+
+        for owner in removed_owners:
+            self._remove_invariant_rules(owner)
+        for owner, rules in added_rules.items():
+            self._add_invariant_rules(owner, rules)
+
+        insert = p4runtime_pb2.Update.INSERT
+        modify = p4runtime_pb2.Update.MODIFY
+        delete = p4runtime_pb2.Update.DELETE
+        updates = defaultdict(list) # switch -> [ (update type, rule) ]
+        for (sw_name, key), old_rule in before.items():
+            new_rule = self._installed_rule(sw_name, key)
+            if new_rule is old_rule:
+                continue
+            if new_rule == None:
+                updates[sw_name].append((delete, old_rule))
+            elif old_rule == None:
+                updates[sw_name].append((insert, new_rule))
+            else:
+                new_action = self.rule_keys.rule_action(new_rule)
+                if new_action != self.rule_keys.rule_action(old_rule):
+                    updates[sw_name].append((modify, new_rule))
+        return updates
+
+    def _install_update(self, updates, summary):
+        "Writes the entry updates of an update to the switches"
+        delete = p4runtime_pb2.Update.DELETE
+
+        def _write_updates(sw_name):
+            # Deletions first, since table capacity is limited
+            sw_updates = sorted(updates[sw_name],
+                                key=lambda update: update[0] != delete)
+            encoded = [(update_type, self._encode_rule(rule))
+                       for update_type, rule in sw_updates]
+            rules = [rule for _, rule in sw_updates]
+            self._write_switch_updates(sw_name, encoded, rules)
+
+        start = time.perf_counter()
+        self._run_on_switches(_write_updates, list(updates.keys()))
+        end = time.perf_counter()
+        num_updates = sum(len(sw_updates) for sw_updates in updates.values())
+        print('{}, {} rules updated'.format(summary, num_updates))
+        print('Install time:', end - start, 'seconds')
+
+    def update_network(self, network):
+        """
+        Applies a change of the network (e.g., links going down or back up, or
+        ports added) to the verification rules on the running switches. The
+        DFAs of the regex invariants are updated incrementally when the new
+        topology allows it (see DFA.update_topology), and otherwise constructed
+        again by the compiler workers (see compile_invariants). Only the
+        entries whose installed rules change are written. The forwarding rules
+        are left as they are.
+        """
+        apply = self._compile_network_update(network)
+        self._install_update(*apply())
+
+    def _compile_network_update(self, network):
+        """
+        Compiles the rules of a change of the network, like
+        _compile_invariants_update. Only the DFAs of the invariants and the
+        groups of the RuleMerger change, which the event loop tasks do not
+        read.
+        """
+        if network['switches'].keys() != self.network['switches'].keys():
+            raise Exception('Switches cannot be added or removed')
+        old_topo = self.topology
+        topo = Topology(network)
+
+        start = time.perf_counter()
+        compiled_parts = dict() # invariant ID -> rule parts
+        rebuilt = [] # invariants whose DFAs are constructed again
+        for invariant in self.invariants.values():
+            if not isinstance(invariant, RegexInvariant):
+                continue
+            changed = invariant.update_topology(topo)
+            if changed == None:
+                rebuilt.append(invariant)
+            elif changed or topo.border_switches != old_topo.border_switches:
+                compiled_parts[invariant.id] = compile_invariant(
+                    invariant, topo, range_encoder=self.range_encoder)
+        compiled = compile_invariants(rebuilt, topo, self.compile_workers,
+                                      self.dfa_cache, self.range_encoder)
+        for invariant, (rule_parts, _) in zip(rebuilt, compiled):
+            compiled_parts[invariant.id] = rule_parts
+        added_rules = self.rule_merger.merge(self.invariants.values(), topo,
+                                             compiled_parts)
+        end = time.perf_counter()
+        print('Compile time:', end - start, 'seconds')
+        num_changed = len(added_rules)
+
+        def apply():
+            self.network = network
+            self.topology = topo
+            if ENCAP_DECAP in self.inv_rule_keys:
+                added_rules[ENCAP_DECAP] = self._encap_decap_rules()
+            updates = self._apply_rules(list(added_rules.keys()), added_rules)
+            summary = 'Network: {} invariants changed ({} rebuilt)'.format(
+                num_changed, len(rebuilt))
+            return updates, summary
+
+        return apply
+
+    async def _run_update(self, compile_update, *args):
+        """
+        Runs an update of the invariants or of the network while the event loop
+        runs. It is compiled and its rules are written in the executor, but it
+        is applied to the invariants and the installed rules on the event loop
+        thread, so that the tasks of the switches never see them changing. The
+        updates run one at a time.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.update_lock:
+            apply = await loop.run_in_executor(None, compile_update, *args)
+            updates, summary = apply()
+            await loop.run_in_executor(None, self._install_update, updates,
+                                       summary)
+
+    def add_invariant(self, inv_spec):
+        return self.update_invariants(added_specs=[inv_spec])[0]
+
+    def remove_invariant(self, inv_id):
+        self.update_invariants(removed_ids=[inv_id])
+
+    def sync_invariants(self, inv_specs):
+        # Updates the invariants to the given specifications, matched by name:
+        # new and changed ones are (re)compiled, and the others are kept
+        added_specs, removed_ids = self._diff_invariants(inv_specs)
+        if len(removed_ids) > 0 or len(added_specs) > 0:
+            self.update_invariants(added_specs, removed_ids)
+
+    def _diff_invariants(self, inv_specs):
+        # Specifications of the new and changed invariants, and IDs of the
+        # removed and changed ones
+        current = {inv.name: inv for inv in self.invariants.values()}
+        specs = {inv_spec['name']: inv_spec for inv_spec in inv_specs}
+        removed_ids = [
+            inv.id
+            for name, inv in current.items()
+            if name not in specs or specs[name] != inv.spec
+        ]
+        added_specs = [
+            inv_spec for name, inv_spec in specs.items()
+            if name not in current or current[name].spec != inv_spec
+        ]
+        return added_specs, removed_ids
+
+    async def watch_invariants_file(self, interval=INVARIANTS_WATCH_INTERVAL):
+        # Applies the changes of the invariants file while the controller runs.
+        # The file is read in the executor (see _run_update).
+        loop = asyncio.get_running_loop()
+        stat = await loop.run_in_executor(None, os.stat, self.inv_json)
+        mtime = stat.st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stat = await loop.run_in_executor(None, os.stat, self.inv_json)
+                if stat.st_mtime == mtime:
+                    continue
+                mtime = stat.st_mtime
+                inv_specs = await loop.run_in_executor(None,
+                                                       InvariantsParser.load,
+                                                       self.inv_json)
+                added_specs, removed_ids = self._diff_invariants(inv_specs)
+                if len(removed_ids) == 0 and len(added_specs) == 0:
+                    continue
+                print('Updating invariants from', self.inv_json)
+                added = self._build_invariants(added_specs, removed_ids)
+                await self._run_update(self._compile_invariants_update, added,
+                                       removed_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('Failed to update invariants: {}'.format(e))
+
+    def _read_network(self):
+        with open(self.network_json, 'r') as infile:
+            return json.load(infile)
+
+    async def watch_network_file(self, interval=NETWORK_WATCH_INTERVAL):
+        # Applies the changes of the network file (e.g., links going down or
+        # back up) to the verification rules while the controller runs
+        loop = asyncio.get_running_loop()
+        stat = await loop.run_in_executor(None, os.stat, self.network_json)
+        mtime = stat.st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stat = await loop.run_in_executor(None, os.stat,
+                                                  self.network_json)
+                if stat.st_mtime == mtime:
+                    continue
+                mtime = stat.st_mtime
+                network = await loop.run_in_executor(None, self._read_network)
+                print('Updating the network from', self.network_json)
+                await self._run_update(self._compile_network_update, network)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('Failed to update the network: {}'.format(e))
+
     def read_table_rules(self, switch_name):
         sw_conn = self.sw_conns[switch_name]
         print('\n----- Reading tables rules for %s -----' % sw_conn.name)
@@ -243,34 +842,44 @@ class Controller:
                 print()
 
     def process_packet_in(self, sw_conn, packet):
-        invId = int.from_bytes(packet.metadata[0].value, byteorder='big')
-        pkt_bytes = packet.payload
-        eth = ethernet.Ethernet(pkt_bytes)
-        print('Violation occurred at', sw_conn.name)
-        print('Violated invariant:')
-        print(self.invariants[invId])
-        print(eth)
-
-    def process_switch(self, sw_conn):
+        violation = decode_packet_in(sw_conn.name, packet, time.time())
+        self.violations.process(violation)
+
+    async def process_switch(self, stream_conn):
         try:
-            while True:
-                result = sw_conn.PacketIn()
-                if result.WhichOneof('update') == 'packet':
-                    self.process_packet_in(sw_conn, result.packet)
+            async for packet in stream_conn.PacketIns():
+                # A malformed packet-in must not stop the switch's task
+                try:
+                    self.process_packet_in(stream_conn, packet)
+                except Exception as e:
+                    print('Invalid packet-in from {}: {}'.format(
+                        stream_conn.name, e))
+        except asyncio.CancelledError:
+            raise
         except grpc.RpcError as e:
             printGrpcError(e)
         except Exception as e:
             print(e)
 
+    async def flush_violations(self):
+        # Report the aggregated violations even if no more packets arrive
+        while True:
+            await asyncio.sleep(self.violations.window)
+            self.violations.flush(time.time())
+
     async def async_start(self):
         try:
             self.set_reduced_MTU()
-            self.connect()
-            self.install_P4_programs()
-            print('Installing forwarding rules')
-            self.install_rules(self.network['rules'])
-            print('Installing verification rules')
-            self.install_verification_rules()
+            await self.async_connect()
+            if self.reconcile_mode:
+                print('Reconciling the switches')
+                self.reconcile()
+            else:
+                self.install_P4_programs()
+                print('Installing forwarding rules')
+                self.install_rules(self.network['rules'])
+                print('Installing verification rules')
+                self.install_verification_rules()
         except grpc.RpcError as e:
             printGrpcError(e)
             raise
@@ -282,11 +891,19 @@ class Controller:
         print('Start controller-switch event loops')
         print('===========================================')
 
-        # Process each switch asynchronously
-        loop = asyncio.get_running_loop()
-        for sw_conn in self.sw_conns.values():
+        # Process each switch in its own task of the event loop
+        for stream_conn in self.stream_conns.values():
+            self.futures.append(
+                asyncio.create_task(self.process_switch(stream_conn)))
+        self.futures.append(asyncio.create_task(self.flush_violations()))
+        # Created in the event loop, which older Pythons bind it to
+        self.update_lock = asyncio.Lock()
+        if self.watch_invariants:
             self.futures.append(
-                loop.run_in_executor(None, self.process_switch, sw_conn))
+                asyncio.create_task(self.watch_invariants_file()))
+        if self.watch_network:
+            self.futures.append(asyncio.create_task(self.watch_network_file()))
+        await asyncio.gather(*self.futures)
 
     def start(self):
         try:
@@ -299,6 +916,7 @@ class Controller:
         try:
             for future in self.futures:
                 future.cancel()
+            self.violations.close(time.time())
             # ShutdownAllSwitchConnections()
         except:
             pass
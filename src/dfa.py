@@ -3,159 +3,438 @@
 from collections import defaultdict, deque
 import graphviz
 
-from .regex import Regex
+from .regex import Regex, positions
 
 
 class DFA:
 
-    def __init__(self, regex, network, fn='dfa'):
+    def __init__(self, regex, topo, fn='dfa'):
+        self.name = fn
         self.states = set()
         self.initial = None
         self.accepting = set()
         self.transitions = defaultdict(dict)
-        self._construct(regex.ast, network)
+        self.blocks = None
+        self._construct(regex.ast)
         self._simplify_states()
         self.export_transition_diagram(fn + '.orig')
-        self._topo_constraints_opt(network)
+
+        # The constructed DFA (the base) and the symbolic locations of its
+        # states are kept to update the DFA when the topology changes (see
+        # update_topology)
+        self.base_topo = topo
+        self.base_initial = self.initial
+        self.base_accepting = self.accepting
+        self.base_transitions = self.transitions
+        self.topo = topo
+        self.sym_locs = dict() # base state -> symbolic location (set())
+        self.valid_transitions = dict() # base state -> valid transitions
+        self._topo_constraints_opt(topo, self.states)
+        self._minimize()
+        self._simplify_states()
         self.export_transition_diagram(fn)
 
-    def _construct(self, ast, network):
-        alphabet, drop_alph = Regex.compute_alphabet(network)
+    @classmethod
+    def from_table(cls,
+                   states,
+                   initial,
+                   accepting,
+                   transitions,
+                   base=None,
+                   blocks=None):
+        # Rebuild a DFA from its final transition table (e.g., loaded from the
+        # DFA cache) without constructing it from a regex. It can be updated to
+        # topology changes only with its base (initial state, accepting states
+        # and transitions) and its blocks (see _minimize); the symbolic
+        # locations of the base states are then computed on the first update.
+        dfa = cls.__new__(cls)
+        dfa.name = None
+        dfa.states = set(states)
+        dfa.initial = initial
+        dfa.accepting = set(accepting)
+        dfa.transitions = transitions
+        dfa.blocks = blocks
+        dfa.base_topo = None
+        dfa.base_transitions = None
+        dfa.topo = None
+        if base != None and blocks != None:
+            dfa.base_initial, dfa.base_accepting, dfa.base_transitions = base
+            dfa.sym_locs = None
+            dfa.valid_transitions = None
+        return dfa
+
+    def __getstate__(self):
+        # The topologies are not pickled with the DFA (e.g., when a compiler
+        # worker sends it back), see set_topology
+        state = self.__dict__.copy()
+        state['base_topo'] = None
+        state['topo'] = None
+        return state
+
+    def set_topology(self, topo):
+        "Restores the topology of an unpickled DFA, which was constructed on it"
+        self.topo = topo
+        if self.base_transitions != None:
+            self.base_topo = topo
+
+    def _construct(self, ast):
         firstpos, _, followpos = ast.getPositions()
         tokenPosMap = ast.getTokenPosMap()
+        posTokenMap = ast.getPosTokenMap()
 
-        self.initial = frozenset(firstpos[ast.root])
+        # The states are bitmasks of positions during the construction
+        self.initial = firstpos[ast.root]
         self.states.add(self.initial)
         q = deque()
         q.append(self.initial)
 
         while len(q) > 0:
             cur_state = q.popleft()
-            for a in alphabet.union(drop_alph):
-                nextstate = set()
-                matchedPositions = cur_state & tokenPosMap[a]
-                for pos in matchedPositions:
-                    nextstate |= followpos[pos]
-                nextstate = frozenset(nextstate)
+            # Only the symbols at the positions of the current state have
+            # transitions, so the cost does not depend on the alphabet size.
+            next_states = defaultdict(int)
+            for pos in positions(cur_state):
+                a = posTokenMap[pos]
+                if a != Regex.OP_END:
+                    next_states[a] |= followpos[pos]
+            for a, nextstate in next_states.items():
                 # This if statement removes all the invalid input transitions
-                if len(nextstate) == 0:
+                if nextstate == 0:
                     continue
                 if nextstate not in self.states:
                     self.states.add(nextstate)
                     q.append(nextstate)
                 self.transitions[cur_state][a] = nextstate
 
-        assert (len(tokenPosMap[Regex.OP_END]) == 1)
+        end_mask = tokenPosMap[Regex.OP_END]
+        assert (end_mask != 0 and end_mask & (end_mask - 1) == 0)
         for state in self.states:
-            if tokenPosMap[Regex.OP_END].issubset(state):
+            if state & end_mask:
                 self.accepting.add(state)
 
+    def _reachable_states(self):
+        # Reachable states in breadth-first order. Inputs are visited in sorted
+        # order so that the order is deterministic.
+        order = [self.initial]
+        visited = set(order)
+        q = deque(order)
+        while len(q) > 0:
+            state = q.popleft()
+            trans = self.transitions.get(state, {})
+            for input_ in sorted(trans.keys()):
+                if trans[input_] not in visited:
+                    visited.add(trans[input_])
+                    order.append(trans[input_])
+                    q.append(trans[input_])
+        return order
+
+    def canonical_key(self):
+        """
+        Key of the minimized DFA that is the same for all the DFAs of the same
+        language, whatever the numbering of their states: the accepting states
+        and the transitions of the states renumbered in breadth-first order
+        (see _reachable_states), with the initial state as 0.
+        """
+        order = self._reachable_states()
+        number = {state: i for i, state in enumerate(order)}
+        accepting = sorted(
+            number[state] for state in self.accepting if state in number)
+        transitions = []
+        for state in order:
+            trans = self.transitions.get(state, {})
+            transitions.append(
+                tuple(
+                    sorted((input_, number[next_state])
+                           for input_, next_state in trans.items())))
+        return tuple(accepting), tuple(transitions)
+
     def _simplify_states(self):
+        # Renumber the reachable states in breadth-first order
+        self._remap_states({
+            state: i for i, state in enumerate(self._reachable_states())
+        })
+
+    def _remap_states(self, remap):
+        # Renumber the states in remap and drop the others
+        self.states = set(remap.values())
+        self.initial = remap[self.initial]
+        self.accepting = set(
+            remap[state] for state in self.accepting if state in remap)
+        self.transitions = {
+            remap[state]: {
+                input_: remap[next_state] for input_, next_state in
+                self.transitions.get(state, {}).items()
+            } for state in remap
+        }
+        if self.blocks != None:
+            self.blocks = {remap[state]: self.blocks[state] for state in remap}
+
+    def _renumber_states(self, old_blocks):
+        # Renumber the reachable states after an update of the topology. Each
+        # state keeps the number of the old state that contained its first base
+        # state if possible, so that the rules of the unchanged parts of the DFA
+        # stay the same; the others get the lowest free numbers.
+        old_numbers = dict() # base state -> old number
+        for number, base_states in old_blocks.items():
+            for base_state in base_states:
+                old_numbers[base_state] = number
         remap = dict()
-        newstates = set()
-        newinitial = None
-        newaccepting = set()
-        newtransitions = defaultdict(dict)
-
-        def __preorder_remap(state, i):
-            remap[state] = i
-            newstates.add(i)
-            i += 1
-            for next_state in self.transitions[state].values():
-                if next_state not in remap:
-                    __preorder_remap(next_state, i)
-
-        __preorder_remap(self.initial, 0)
-
-        newinitial = remap[self.initial]
-        for state, trans in self.transitions.items():
-            for input_, nextstate in trans.items():
-                newtransitions[remap[state]][input_] = remap[nextstate]
-        for state in self.accepting:
-            newaccepting.add(remap[state])
-
-        self.states = newstates
-        self.initial = newinitial
-        self.accepting = newaccepting
-        self.transitions = dict(newtransitions)
-
-    def _topo_constraints_opt(self, network):
-
-        def __gather_intfs(state, sym_loc, network):
+        used = set()
+        order = self._reachable_states()
+        for state in order:
+            for base_state in sorted(self.blocks[state]):
+                number = old_numbers.get(base_state)
+                if number != None and number not in used:
+                    remap[state] = number
+                    used.add(number)
+                    break
+        number = 0
+        for state in order:
+            if state not in remap:
+                while number in used:
+                    number += 1
+                remap[state] = number
+                used.add(number)
+        self._remap_states(remap)
+
+    def _topo_constraints_opt(self, topo, affected):
+        # Prune the transitions of the base that are impossible in the topology.
+        # The symbolic location of a state is the set of devices where a packet
+        # can be in that state; it is computed as a fixed point for the affected
+        # states, while the other states keep theirs, which must not depend on
+        # the affected ones.
+
+        def __gather_intfs(state, sym_loc):
             sym_intfs = set()
             for loc in sym_loc:
-                if loc in network['hosts']:
+                if loc in topo.hosts:
                     # Only the initial state can enter the network
-                    if state == self.initial:
-                        for intf in network['hosts'][loc]['intfs'].values():
-                            if 'neighborNode' not in intf:
-                                continue
-                            sym_intfs.add(intf['neighborNode'] + 'p' +
-                                          str(intf['neighborPort']))
-                elif loc in network['switches']:
-                    for intf in network['switches'][loc]['intfs'].values():
-                        if 'neighborNode' not in intf:
-                            continue
-                        sym_intfs.add(loc + 'p' + str(intf['port']))
+                    if state == self.base_initial:
+                        sym_intfs |= topo.dev_endpoints[loc]
+                elif loc in topo.dev_ports:
+                    sym_intfs |= topo.dev_ports[loc]
                 else:
                     raise Exception('Unknown device ' + loc)
             return sym_intfs
 
-        def __process_next_state(q, visited_states, invalid_inputs, network):
-            cur_state, sym_loc = q.popleft()
+        def __next_states(state, sym_loc):
+            # Valid transitions of the state, and the symbolic locations that
+            # they lead to
+            valid = dict()
             next_states = defaultdict(set)
-
-            if cur_state not in visited_states:
-                visited_states[cur_state] = sym_loc
-            elif not sym_loc.issubset(visited_states[cur_state]):
-                visited_states[cur_state] |= sym_loc
-                sym_loc = visited_states[cur_state]
-            else:
-                return
-
-            if cur_state not in self.transitions:
-                return
-
-            # Gather all valid interfaces for sym_loc
-            sym_intfs = __gather_intfs(cur_state, sym_loc, network)
-            invalid_inputs[cur_state] = set()
-
-            for input_, next_state in self.transitions[cur_state].items():
+            sym_intfs = __gather_intfs(state, sym_loc)
+            for input_, next_state in self.base_transitions[state].items():
                 # Check if input_ is plausible given the current sym_loc
                 if input_ not in sym_intfs:
-                    invalid_inputs[cur_state].add(input_)
                     continue
 
-                egress_node = input_[:input_.rfind('p')]
-                egress_port = input_[input_.rfind('p') + 1:]
-                egress_intf = egress_node + '-eth' + egress_port
-                intf = network['switches'][egress_node]['intfs'][egress_intf]
-                if 'neighborNode' not in intf:
-                    invalid_inputs[cur_state].add(input_)
+                sym_id = topo.symbol_ids[input_]
+                egress_node = topo.sym_switch[sym_id]
+                neighbor_node = topo.sym_neighbor[sym_id]
+                if neighbor_node == None:
                     continue
+                valid[input_] = next_state
 
-                neighbor_node = intf['neighborNode']
-                if (neighbor_node in network['hosts'] and
-                        neighbor_node in sym_loc):
+                if neighbor_node in topo.hosts and neighbor_node in sym_loc:
                     next_states[next_state].add(egress_node)
                 if egress_node in sym_loc:
                     next_states[next_state].add(neighbor_node)
+            return valid, next_states
+
+        for state in affected:
+            self.sym_locs.pop(state, None)
+            self.valid_transitions.pop(state, None)
 
+        q = deque()
+        if self.base_initial in affected:
+            q.append((self.base_initial, set(topo.hosts)))
+        # The unaffected states only contribute their symbolic locations
+        for state, sym_loc in self.sym_locs.items():
+            _, next_states = __next_states(state, sym_loc)
+            for next_state, next_sym_loc in next_states.items():
+                if next_state in affected:
+                    q.append((next_state, next_sym_loc))
+
+        while len(q) > 0:
+            state, sym_loc = q.popleft()
+            if state not in self.sym_locs:
+                self.sym_locs[state] = sym_loc
+            elif not sym_loc.issubset(self.sym_locs[state]):
+                self.sym_locs[state] |= sym_loc
+                sym_loc = self.sym_locs[state]
+            else:
+                continue
+            valid, next_states = __next_states(state, sym_loc)
+            self.valid_transitions[state] = valid
             # Push all (next_state, next_sym_loc) entries to the queue
             for next_state, next_sym_loc in next_states.items():
                 q.append((next_state, next_sym_loc))
 
-        q = deque()
-        q.append((self.initial, set(network['hosts'].keys())))
-        visited_states = dict() # state -> symbolic location (set())
-        invalid_inputs = dict() # state -> invalid inputs (set())
+        # Keep the valid inputs after reaching the fixed point. The states
+        # without symbolic location keep their transitions on the symbols that
+        # still exist.
+        self.initial = self.base_initial
+        self.accepting = self.base_accepting
+        self.transitions = dict()
+        for state, trans in self.base_transitions.items():
+            valid = self.valid_transitions.get(state)
+            if valid == None:
+                valid = {
+                    input_: next_state
+                    for input_, next_state in trans.items()
+                    if input_ in topo.symbol_ids
+                }
+            self.transitions[state] = valid
+        self.states = set(self.transitions.keys())
+
+    def can_update_topology(self, topo, twins=None):
+        return (self.base_transitions != None and self.base_topo != None and
+                topo.is_restriction_of(self.base_topo, set(twins or ())))
+
+    def update_topology(self, topo, twins=None):
+        """
+        Update the DFA to a new topology (e.g., with links down or back up, or
+        ports added) that can_update_topology accepts, without constructing it
+        again. The symbols added to the base topology are given with their
+        twins (added symbol -> base symbol), on which the base has the same
+        transitions. Only the states whose valid inputs may change are
+        recomputed: the base states with transitions on the changed symbols,
+        and the states reachable from them, whose symbolic locations may
+        change. The states keep their numbers where possible, so that few rules
+        change. Returns whether the DFA changed.
+        """
+        old_dfa = (self.initial, self.accepting, self.transitions)
+        if self.sym_locs == None:
+            # Loaded from the DFA cache without the symbolic locations, which
+            # are computed on the current topology. This also prunes the base
+            # again, so the DFA is restored.
+            self.sym_locs = dict()
+            self.valid_transitions = dict()
+            self._topo_constraints_opt(self.topo,
+                                       set(self.base_transitions.keys()))
+            self.initial, self.accepting, self.transitions = old_dfa
+            self.states = set(self.transitions.keys())
+        # Extend the base on the added symbols
+        for symbol, twin in (twins or {}).items():
+            for trans in self.base_transitions.values():
+                if twin in trans:
+                    trans[symbol] = trans[twin]
+
+        changed_symbols = self.topo.changed_symbols(topo)
+        self.topo = topo
+        affected = set(state for state, trans in self.base_transitions.items()
+                       if not changed_symbols.isdisjoint(trans.keys()))
+        if len(affected) == 0:
+            return False
+        q = deque(affected)
         while len(q) > 0:
-            __process_next_state(q, visited_states, invalid_inputs, network)
+            state = q.popleft()
+            for next_state in self.base_transitions[state].values():
+                if next_state not in affected:
+                    affected.add(next_state)
+                    q.append(next_state)
 
-        # Delete the invalid inputs after reaching the fixed point
-        for state, inputs in invalid_inputs.items():
+        old_dfa = (self.initial, self.accepting, self.transitions)
+        old_blocks = self.blocks
+        self._topo_constraints_opt(topo, affected)
+        self._minimize()
+        self._renumber_states(old_blocks)
+        if (self.initial, self.accepting, self.transitions) == old_dfa:
+            return False
+        self.export_transition_diagram(self.name)
+        return True
+
+    def _minimize(self):
+        # Hopcroft's partition refinement. Missing transitions go to an implicit
+        # dead state, which absorbs every state that cannot reach an accepting
+        # state; transitions into it are dropped as they are violations anyway.
+        DEAD = None
+        num_states = len(self.states)
+        num_transitions = sum(len(trans) for trans in self.transitions.values())
+
+        # Reachable states
+        reachable = set([self.initial])
+        q = deque([self.initial])
+        while len(q) > 0:
+            state = q.popleft()
+            for next_state in self.transitions.get(state, {}).values():
+                if next_state not in reachable:
+                    reachable.add(next_state)
+                    q.append(next_state)
+
+        # Inverse transitions: state -> input -> { predecessors }
+        inputs = set()
+        for state in reachable:
+            inputs |= self.transitions.get(state, {}).keys()
+        inverse = defaultdict(lambda: defaultdict(set))
+        for state in reachable:
+            trans = self.transitions.get(state, {})
             for input_ in inputs:
-                del self.transitions[state][input_]
+                inverse[trans.get(input_, DEAD)][input_].add(state)
+        for input_ in inputs:
+            inverse[DEAD][input_].add(DEAD)
+
+        # Initial partition: accepting and non-accepting states
+        accepting = reachable & self.accepting
+        non_accepting = (reachable - accepting) | set([DEAD])
+        # The blocks are split in place, so they must not share the sets
+        blocks = [set(b) for b in (accepting, non_accepting) if len(b) > 0]
+        block_of = dict()
+        for i, block in enumerate(blocks):
+            for state in block:
+                block_of[state] = i
+        worklist = set([min(range(len(blocks)), key=lambda i: len(blocks[i]))])
+
+        while len(worklist) > 0:
+            splitter = list(blocks[worklist.pop()])
+            preds_by_input = defaultdict(set)
+            for state in splitter:
+                for input_, preds in inverse[state].items():
+                    preds_by_input[input_] |= preds
+            for preds in preds_by_input.values():
+                # Split every block that is partially covered by preds
+                touched = defaultdict(set)
+                for state in preds:
+                    touched[block_of[state]].add(state)
+                for i, subset in touched.items():
+                    if len(subset) == len(blocks[i]):
+                        continue
+                    blocks[i] -= subset
+                    blocks.append(subset)
+                    j = len(blocks) - 1
+                    for state in subset:
+                        block_of[state] = j
+                    if i in worklist or len(subset) <= len(blocks[i]):
+                        worklist.add(j)
+                    else:
+                        worklist.add(i)
+
+        # Build the quotient DFA without the dead block
+        dead = block_of[DEAD]
+        transitions = dict()
+        for state in reachable:
+            i = block_of[state]
+            if i == dead or i in transitions:
+                continue
+            transitions[i] = dict()
+            for input_, next_state in self.transitions.get(state, {}).items():
+                if block_of[next_state] != dead:
+                    transitions[i][input_] = block_of[next_state]
+        self.initial = block_of[self.initial]
+        if self.initial not in transitions:
+            # No accepting state is reachable at all
+            transitions[self.initial] = dict()
+        self.states = set(transitions.keys())
+        self.accepting = set(block_of[state] for state in accepting)
+        self.transitions = transitions
+        # States of the DFA before the minimization in each state
+        self.blocks = {i: blocks[i] - set([DEAD]) for i in transitions}
+
+        num_removed_states = num_states - len(self.states)
+        num_removed_transitions = num_transitions - sum(
+            len(trans) for trans in self.transitions.values())
+        print('DFA minimization ({}): removed {} states, {} transitions'.format(
+            self.name, num_removed_states, num_removed_transitions))
 
     def dump(self):
         print("States: " + str(self.states))
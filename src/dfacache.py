@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+
+from .dfa import DFA
+
+
+class DFACache:
+    """
+    Persistent on-disk cache of the DFAs compiled from regex invariants. Entries
+    are content-addressed by the regex pattern and the parts of the network that
+    the DFA depends on, so an unchanged invariant is loaded without rebuilding
+    its regex AST and DFA. The entries keep the base of the DFA, so that a
+    loaded DFA can be updated to topology changes.
+    """
+
+    # Bump whenever the DFA construction or the format of the entries changes
+    VERSION = 4
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(pattern, topo):
+        content = {
+            'version': DFACache.VERSION,
+            'pattern': pattern,
+            'topology': topo.fingerprint,
+        }
+        content = json.dumps(content, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.dfa')
+
+    def load(self, key):
+        try:
+            with open(self._path(key), 'rb') as infile:
+                table = json.loads(zlib.decompress(infile.read()))
+            symbols = table['symbols']
+            transitions = self._load_transitions(symbols, table['transitions'])
+            base = (table['base']['initial'], set(table['base']['accepting']),
+                    self._load_transitions(symbols,
+                                           table['base']['transitions']))
+            blocks = {state: set(states) for state, states in table['blocks']}
+            return DFA.from_table(table['states'], table['initial'],
+                                  table['accepting'], transitions, base, blocks)
+        except (OSError, ValueError, zlib.error, KeyError, TypeError,
+                IndexError):
+            # Missing, truncated or old-format entry
+            return None
+
+    @staticmethod
+    def _load_transitions(symbols, table):
+        # Transitions: [ [state, [symbol index, next state, ...]], ... ]
+        transitions = dict()
+        for state, trans in table:
+            transitions[state] = {
+                symbols[trans[i]]: trans[i + 1] for i in range(0, len(trans), 2)
+            }
+        return transitions
+
+    @staticmethod
+    def _store_transitions(symbol_ids, transitions):
+        table = []
+        for state, trans in sorted(transitions.items()):
+            flat_trans = []
+            for input_, next_state in sorted(trans.items()):
+                flat_trans += [symbol_ids[input_], next_state]
+            table.append([state, flat_trans])
+        return table
+
+    def store(self, key, dfa):
+        # The base (see DFA.update_topology) has transitions on all the symbols
+        symbols = sorted(
+            set(input_ for trans in dfa.base_transitions.values()
+                for input_ in trans.keys()))
+        symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+        base_transitions = self._store_transitions(symbol_ids,
+                                                   dfa.base_transitions)
+        base = {
+            'initial': dfa.base_initial,
+            'accepting': sorted(dfa.base_accepting),
+            'transitions': base_transitions,
+        }
+        blocks = [[state, sorted(states)]
+                  for state, states in sorted(dfa.blocks.items())]
+        table = {
+            'symbols': symbols,
+            'states': sorted(dfa.states),
+            'initial': dfa.initial,
+            'accepting': sorted(dfa.accepting),
+            'transitions': self._store_transitions(symbol_ids, dfa.transitions),
+            'base': base,
+            'blocks': blocks,
+        }
+        data = zlib.compress(
+            json.dumps(table, separators=(',', ':')).encode('utf-8'))
+
+        # Write atomically, as multiple compiler processes may share the cache
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(tmp_path, self._path(key))
+        except:
+            os.unlink(tmp_path)
+            raise
@@ -1,23 +1,40 @@
 #!/usr/bin/env python3
 
-import re
 import json
+import time
+import itertools
+import ipaddress
 from abc import *
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from .constants import *
 from .dfa import DFA
-from .packetset import PacketSet
+from .dfacache import DFACache
+from .packetset import (PacketSet, PacketSetUnion, FIELDS, WIDTHS, IP_FIELDS,
+                        range_to_prefixes, prefix_mask)
 from .regex import Regex
 
+# Keys of the verification tables for the fields of the packet sets
+PACKET_SET_KEYS = {
+    'src_ip': 'hdr.ipv4.srcAddr',
+    'dst_ip': 'hdr.ipv4.dstAddr',
+    'proto': 'meta.verification.protocol',
+    'src_port': 'meta.verification.srcPort',
+    'dst_port': 'meta.verification.dstPort',
+}
+
 
 class Invariant:
 
     def __init__(self, inv_id, inv_spec):
         self.id = inv_id
+        self.spec = inv_spec
         self.name = inv_spec['name']
         self.type = inv_spec['type']
         self.packet_set = PacketSet(inv_spec['packet_set'])
+        if self.packet_set.is_empty():
+            raise Exception('Empty packet set of invariant ' + self.name)
 
     def __str__(self):
         return ('Invariant ' + str(self.id) + '\n' + 'Name: ' + self.name +
@@ -25,9 +42,48 @@ class Invariant:
                 str(self.packet_set))
 
     @abstractmethod
-    def get_rules(self, network):
+    def get_rules(self, topo, dfa_cache=None):
         raise Exception()
 
+    def get_rule_parts(self, topo, dfa_cache=None):
+        """
+        Rules of the invariant in two parts: the DFA rules, which do not depend
+        on the invariant and can be shared (see RuleMerger), and its own rules
+        """
+        return dict(), self.get_rules(topo, dfa_cache)
+
+    def _match_packet_set(self, rules, packet_sets=None):
+        """
+        Adds the match fields of the packet set to the rules, only for the
+        fields that it constrains, as the others match any packet. With a list
+        of packet sets (e.g., the disjoint boxes of a PacketSetUnion), each rule
+        is repeated for each of them.
+        """
+        if packet_sets == None:
+            packet_sets = [self.packet_set]
+        matches = []
+        for packet_set in packet_sets:
+            match_fields = dict()
+            for field, value in packet_set.constrained():
+                if field in IP_FIELDS:
+                    value = (_ipv4(value[0]), _ipv4(value[1]))
+                match_fields[PACKET_SET_KEYS[field]] = value
+            matches.append(match_fields)
+        if len(matches) == 1:
+            for rules_list in rules.values():
+                for rule in rules_list:
+                    rule['match_fields'].update(matches[0])
+            return rules
+        matched = defaultdict(list)
+        for sw_name, rules_list in rules.items():
+            for rule in rules_list:
+                for match_fields in matches:
+                    entry = dict(rule)
+                    entry['match_fields'] = dict(rule['match_fields'])
+                    entry['match_fields'].update(match_fields)
+                    matched[sw_name].append(entry)
+        return matched
+
 
 class RegexInvariant(Invariant):
 
@@ -40,30 +96,97 @@ class RegexInvariant(Invariant):
     def __str__(self):
         return (super().__str__() + '\n' + 'Pattern: ' + self.pattern)
 
-    def get_rules(self, network):
+    def _build_dfa(self, topo, dfa_cache):
+        if dfa_cache != None:
+            key = DFACache.key(self.pattern, topo)
+            self.dfa = dfa_cache.load(key)
+            if self.dfa != None:
+                self.dfa.name = self.name
+                self.dfa.set_topology(topo)
+                return
         if self.regex == None:
-            self.regex = Regex(self.pattern, network)
+            self.regex = Regex(self.pattern, topo)
+        self.dfa = DFA(self.regex, topo, fn=self.name)
+        if dfa_cache != None:
+            dfa_cache.store(key, self.dfa)
+
+    def _twin_symbols(self, topo):
+        """
+        Twins of the symbols that topo adds to the base topology of the DFA
+        (e.g., of new ports): base symbols in the same operands of the pattern
+        (see Regex.operand_sets), on which the base of the DFA has the same
+        transitions as it would have on the added symbols. Returns None if an
+        added symbol has no twin.
+        """
+        base_topo = self.dfa.base_topo
+        added = topo.all_alph - base_topo.all_alph
+        if len(added) == 0:
+            return dict()
+        base_operands = Regex.operand_sets(self.pattern, base_topo.macros)
+        try:
+            operands = Regex.operand_sets(self.pattern, topo.macros)
+        except Exception:
+            # E.g., an endpoint of the pattern is no longer connected
+            return None
+        twins = dict() # operands of the symbol -> base symbol
+        for symbol in sorted(base_topo.all_alph):
+            twins.setdefault(
+                tuple(symbol in endpoints for endpoints in base_operands),
+                symbol)
+        added_twins = dict()
+        for symbol in added:
+            twin = twins.get(
+                tuple(symbol in endpoints for endpoints in operands))
+            if twin == None:
+                return None
+            added_twins[symbol] = twin
+        return added_twins
+
+    def update_topology(self, topo):
+        """
+        Update the DFA to the new topology incrementally, if the DFA allows it.
+        Returns whether the DFA changed, or None if it must be constructed again
+        on the new topology (see compile_invariants).
+        """
+        if self.dfa == None or self.dfa.base_transitions == None:
+            return None
+        twins = self._twin_symbols(topo)
+        if twins == None or not self.dfa.can_update_topology(topo, twins):
+            self.regex = None
+            self.dfa = None
+            return None
+        return self.dfa.update_topology(topo, twins)
+
+    def get_rules(self, topo, dfa_cache=None):
+        return _join_rules(*self.get_rule_parts(topo, dfa_cache))
+
+    def get_rule_parts(self, topo, dfa_cache=None):
         if self.dfa == None:
-            self.dfa = DFA(self.regex, network, fn=self.name)
-
+            self._build_dfa(topo, dfa_cache)
+        return self.get_dfa_rules(topo), self.get_violation_rules(topo)
+
+    def get_dfa_rules(self, topo, packet_sets=None):
+        """
+        Rules that run the DFA (initialization, transition and acceptance),
+        matching the packet sets (by default, the invariant's). Unlike the
+        violation rules, they do not depend on the invariant, so the invariants
+        with the same DFA can share them (see RuleMerger).
+        """
         rules = defaultdict(list)
-        ep_pattern = re.compile(r'(s\d+)(p(\d+)|d)', flags=re.IGNORECASE)
 
         # DFA initialization rules
         initialTransitions = self.dfa.transitions[self.dfa.initial]
         for input_, next_state in initialTransitions.items():
-            m = ep_pattern.match(input_)
-            sw_name = m.group(1)
-            assert m.group(2).lower() != 'd'
-            in_port = int(m.group(3))
+            sym_id = topo.symbol_ids[input_]
+            sw_name = topo.sym_switch[sym_id]
+            in_port = topo.sym_port[sym_id]
+            assert in_port != None
             # Only check at the border switches
-            if len(network['switches'][sw_name]['host_ports']) == 0:
+            if not topo.is_border(sw_name):
                 continue
             rules[sw_name].append({
                 'table_name': 'MyIngress.regex_init',
                 'match_fields': {
-                    'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                    'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                     'meta.verification.entering': 1,
                     'std_meta.ingress_port': (in_port, in_port)
                 },
@@ -73,35 +196,17 @@ class RegexInvariant(Invariant):
                 },
                 'priority': Priority.HIGH
             })
-        for sw_name, sw_dict in network['switches'].items():
-            # Only check at the border switches
-            if len(sw_dict['host_ports']) == 0:
-                continue
-            rules[sw_name].append({
-                'table_name': 'MyIngress.regex_init',
-                'match_fields': {
-                    'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                    'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
-                    'meta.verification.entering': 1,
-                },
-                'action_name': 'MyIngress.violate',
-                'action_params': {
-                    'invId': self.id
-                },
-                'priority': Priority.LOW
-            })
 
         # DFA transition rules
         for curr_state, trans in self.dfa.transitions.items():
             for input_, next_state in trans.items():
-                m = ep_pattern.match(input_)
-                sw_name = m.group(1)
-                if m.group(2).lower() == 'd':
+                sym_id = topo.symbol_ids[input_]
+                sw_name = topo.sym_switch[sym_id]
+                out_port = topo.sym_port[sym_id]
+                if out_port == None:
                     rules[sw_name].append({
                         'table_name': 'MyIngress.regex_transition',
                         'match_fields': {
-                            'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                            'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                             'hdr.verification.dfaState':
                                 (curr_state, curr_state),
                             'std_meta.egress_spec': DROP_PORT
@@ -115,8 +220,6 @@ class RegexInvariant(Invariant):
                     rules[sw_name].append({
                         'table_name': 'MyEgress.regex_transition',
                         'match_fields': {
-                            'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                            'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                             'hdr.verification.dfaState':
                                 (curr_state, curr_state),
                             'std_meta.egress_spec': (DROP_PORT, DROP_PORT)
@@ -128,12 +231,9 @@ class RegexInvariant(Invariant):
                         'priority': Priority.HIGH
                     })
                 else:
-                    out_port = int(m.group(3))
                     rules[sw_name].append({
                         'table_name': 'MyEgress.regex_transition',
                         'match_fields': {
-                            'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                            'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                             'hdr.verification.dfaState':
                                 (curr_state, curr_state),
                             'std_meta.egress_port': (out_port, out_port)
@@ -144,13 +244,46 @@ class RegexInvariant(Invariant):
                         },
                         'priority': Priority.MEDIUM
                     })
-        for sw_name in network['switches'].keys():
+
+        # DFA acceptance rules
+        for sw_name in topo.border_switches:
+            for state in self.dfa.accepting:
+                rules[sw_name].append({
+                    'table_name': 'MyEgress.regex_terminate',
+                    'match_fields': {
+                        'meta.verification.leaving': 1,
+                        'hdr.verification.dfaState': (state, state),
+                    },
+                    'action_name': 'NoAction',
+                    'action_params': {},
+                    'priority': Priority.HIGH
+                })
+
+        return self._match_packet_set(rules, packet_sets)
+
+    def get_violation_rules(self, topo):
+        "Rules that report the violations of the invariant, at a lower priority"
+        rules = defaultdict(list)
+
+        # DFA initialization rules
+        for sw_name in topo.border_switches:
             rules[sw_name].append({
-                'table_name': 'MyEgress.regex_transition',
+                'table_name': 'MyIngress.regex_init',
                 'match_fields': {
-                    'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                    'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
+                    'meta.verification.entering': 1,
+                },
+                'action_name': 'MyIngress.violate',
+                'action_params': {
+                    'invId': self.id
                 },
+                'priority': Priority.LOW
+            })
+
+        # DFA transition rules
+        for sw_name in topo.switches:
+            rules[sw_name].append({
+                'table_name': 'MyEgress.regex_transition',
+                'match_fields': {},
                 'action_name': 'MyEgress.violate',
                 'action_params': {
                     'invId': self.id
@@ -159,16 +292,10 @@ class RegexInvariant(Invariant):
             })
 
         # DFA termination rules
-        for sw_name, sw_dict in network['switches'].items():
-            # Only check at the border switches
-            if len(sw_dict['host_ports']) == 0:
-                continue
-
+        for sw_name in topo.border_switches:
             rules[sw_name].append({
                 'table_name': 'MyEgress.regex_terminate',
                 'match_fields': {
-                    'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                    'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                     'meta.verification.leaving': 1,
                 },
                 'action_name': 'MyEgress.violate',
@@ -177,21 +304,8 @@ class RegexInvariant(Invariant):
                 },
                 'priority': Priority.LOW
             })
-            for state in self.dfa.accepting:
-                rules[sw_name].append({
-                    'table_name': 'MyEgress.regex_terminate',
-                    'match_fields': {
-                        'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                        'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
-                        'meta.verification.leaving': 1,
-                        'hdr.verification.dfaState': (state, state),
-                    },
-                    'action_name': 'NoAction',
-                    'action_params': {},
-                    'priority': Priority.HIGH
-                })
 
-        return rules
+        return self._match_packet_set(rules)
 
 
 class SegmentationInvariant(Invariant):
@@ -205,7 +319,7 @@ class SegmentationInvariant(Invariant):
         return (super().__str__() + '\n' + 'Switch: ' + self.switch + '\n' +
                 'Port: ' + str(self.port))
 
-    def get_rules(self, network):
+    def get_rules(self, topo, dfa_cache=None):
         rules = defaultdict(list)
 
         # If a packet in the packet set reaches the <switch, port>, a violation
@@ -213,8 +327,6 @@ class SegmentationInvariant(Invariant):
         rules[self.switch].append({
             'table_name': 'MyEgress.segmentation',
             'match_fields': {
-                'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                 'std_meta.egress_spec': (DROP_PORT, DROP_PORT)
             },
             'action_name': 'NoAction',
@@ -223,8 +335,6 @@ class SegmentationInvariant(Invariant):
         rules[self.switch].append({
             'table_name': 'MyEgress.segmentation',
             'match_fields': {
-                'hdr.ipv4.srcAddr': self.packet_set.src_ip(),
-                'hdr.ipv4.dstAddr': self.packet_set.dst_ip(),
                 'std_meta.egress_port': (self.port, self.port)
             },
             'action_name': 'MyEgress.violate',
@@ -234,7 +344,7 @@ class SegmentationInvariant(Invariant):
             'priority': Priority.LOW
         })
 
-        return rules
+        return self._match_packet_set(rules)
 
 
 class LoopInvariant(Invariant):
@@ -245,11 +355,11 @@ class LoopInvariant(Invariant):
     def __str__(self):
         return super().__str__()
 
-    def get_rules(self, network):
+    def get_rules(self, topo, dfa_cache=None):
         return dict() # Disable loop checks for now
         rules = defaultdict(list)
 
-        for sw_name, sw_dict in network['switches'].items():
+        for sw_name, sw_dict in topo.network['switches'].items():
             sw_id = sw_dict['device_id']
             for trace_idx in range(TRACE_LENGTH):
                 rules[sw_name].append({
@@ -279,16 +389,344 @@ invariant_classes = {
 
 class InvariantsParser:
 
+    @staticmethod
+    def load(invariants_json):
+        with open(invariants_json, 'r') as infile:
+            return json.load(infile)
+
+    @staticmethod
+    def build(inv_id, inv_spec):
+        inv_cls = invariant_classes[inv_spec['type']]
+        return inv_cls(inv_id, inv_spec)
+
     @staticmethod
     def parse(invariants_json):
         invariants = []
 
-        with open(invariants_json, 'r') as infile:
-            invs = json.load(infile)
-
-            for inv_id, inv_spec in enumerate(invs):
-                inv_cls = invariant_classes[inv_spec['type']]
-                invariant = inv_cls(inv_id, inv_spec)
-                invariants.append(invariant)
+        invs = InvariantsParser.load(invariants_json)
+        for inv_id, inv_spec in enumerate(invs):
+            invariants.append(InvariantsParser.build(inv_id, inv_spec))
 
         return invariants
+
+
+def _ipv4(value):
+    return str(ipaddress.IPv4Address(value))
+
+
+def _join_rules(*rules):
+    # Joins the rules (switch -> rules) of the parts of an invariant
+    joined = defaultdict(list)
+    for part in rules:
+        for sw_name, rules_list in part.items():
+            joined[sw_name].extend(rules_list)
+    return joined
+
+
+class RangeEncoder:
+    """
+    Compiler stage that encodes the packet set ranges of the rules (IP
+    addresses, protocol and L4 ports) in the match kinds of the table keys:
+    (table name, field name) -> 'range', 'lpm' or 'ternary', as in the P4Info
+    (missing keys are ranges). A range key takes the range as is. For an lpm or
+    ternary key, the range is split into its minimal prefix cover, as prefixes
+    or as value/mask pairs, and a rule is expanded into the cross product of
+    the covers of its fields. The entries of a rule are disjoint, so they all
+    keep its priority.
+    """
+
+    # Keys of the packet set fields -> (width, whether they are IP addresses)
+    KEYS = {
+        PACKET_SET_KEYS[field]: (width, field in IP_FIELDS)
+        for field, width in zip(FIELDS, WIDTHS)
+    }
+
+    def __init__(self, match_kinds=None):
+        self.match_kinds = dict(match_kinds or {})
+
+    @staticmethod
+    def _prefixes(value, width, covers):
+        # Prefix cover of a (low, high) range (IPv4 strings or ints)
+        low, high = (int(ipaddress.ip_address(x)) if isinstance(x, str) else x
+                     for x in value)
+        prefixes = covers.get((low, high, width))
+        if prefixes == None:
+            prefixes = range_to_prefixes(low, high, width)
+            covers[(low, high, width)] = prefixes
+        return prefixes
+
+    def encode(self, rules):
+        """
+        Returns the encoded rules (switch -> rules), their expansion factor
+        (entries per rule), and the expansion factor that prefix covers would
+        have with lpm or ternary keys for all the IP fields, to show what
+        moving range keys would cost.
+        """
+        encoded = defaultdict(list)
+        num_rules = 0
+        num_entries = 0
+        num_prefix_entries = 0
+        covers = dict() # (low, high, width) -> prefixes
+        for sw_name, rules_list in rules.items():
+            for rule in rules_list:
+                num_rules += 1
+                match_fields = rule.get('match_fields', {})
+                expansions = [] # (field, [ encoded values ])
+                prefix_entries = 1
+                for field, (width, is_ip) in self.KEYS.items():
+                    if field not in match_fields:
+                        continue
+                    prefixes = self._prefixes(match_fields[field], width,
+                                              covers)
+                    prefix_entries *= len(prefixes)
+                    kind = self.match_kinds.get((rule['table_name'], field))
+                    encode = _ipv4 if is_ip else int
+                    if kind == 'lpm':
+                        values = [(encode(value), prefix_len)
+                                  for value, prefix_len in prefixes]
+                    elif kind == 'ternary':
+                        values = [(encode(value),
+                                   encode(prefix_mask(prefix_len, width)))
+                                  for value, prefix_len in prefixes]
+                    else:
+                        continue
+                    expansions.append((field, values))
+                num_prefix_entries += prefix_entries
+                if len(expansions) == 0:
+                    encoded[sw_name].append(rule)
+                    num_entries += 1
+                    continue
+                fields = [field for field, _ in expansions]
+                for values in itertools.product(*(v for _, v in expansions)):
+                    entry = dict(rule)
+                    entry['match_fields'] = dict(match_fields)
+                    entry['match_fields'].update(zip(fields, values))
+                    encoded[sw_name].append(entry)
+                    num_entries += 1
+
+        if num_rules == 0:
+            return encoded, 1.0, 1.0
+        return (encoded, num_entries / num_rules,
+                num_prefix_entries / num_rules)
+
+    def encode_invariant(self, invariant, rule_parts):
+        """
+        Encodes the rule parts of an invariant (see Invariant.get_rule_parts)
+        and reports the expansion
+        """
+        encoded = []
+        num_rules = 0
+        num_entries = 0
+        num_prefix_entries = 0
+        for rules in rule_parts:
+            part_rules = sum(len(rules_list) for rules_list in rules.values())
+            rules, expansion, prefix_expansion = self.encode(rules)
+            encoded.append(rules)
+            num_rules += part_rules
+            num_entries += expansion * part_rules
+            num_prefix_entries += prefix_expansion * part_rules
+        num_rules = max(num_rules, 1)
+        print('Range encoding ({}): expansion factor {:.2f} ({:.2f} with '
+              'prefixes)'.format(invariant.name, num_entries / num_rules,
+                                 num_prefix_entries / num_rules))
+        return tuple(encoded)
+
+
+class RuleMerger:
+    """
+    Compiler pass that groups the regex invariants by their canonical minimized
+    DFAs (see DFA.canonical_key), and emits the DFA rules of each group once:
+    on the union of the packet sets of its invariants, as disjoint boxes (see
+    PacketSetUnion), and with the DFA of its first invariant. Only the
+    violation rules, which report the invariant ID, stay per invariant. All the
+    invariants of a group own the shared rules, so they stay installed as long
+    as one of them does.
+
+    A group is merged only if, once range encoded, this takes fewer entries in
+    total and no more on any switch than the DFA rules of its invariants on
+    their own packet sets. The entries are counted by their keys (see
+    RuleKeys), as installed. The groups are kept from one pass to the next, so
+    that only the groups whose invariants change are merged again.
+    """
+
+    def __init__(self, rule_keys, range_encoder=None):
+        self.rule_keys = rule_keys
+        self.range_encoder = range_encoder
+        # Invariant ID -> encoded rule parts (see Invariant.get_rule_parts)
+        self.rule_parts = dict()
+        # Invariant ID -> (canonical DFA key, IDs of the group) in the last pass
+        self.signatures = dict()
+        self.merged = set() # IDs of the invariants with shared DFA rules
+        self.saved = dict() # canonical DFA key -> switch -> rules saved
+
+    def _encode(self, rules):
+        if self.range_encoder == None:
+            return rules
+        return self.range_encoder.encode(rules)[0]
+
+    def _entries(self, rules_list):
+        return set(self.rule_keys.rule_key(rule) for rule in rules_list)
+
+    def _merge_group(self, group, topo):
+        # Returns the shared DFA rules of the group and the rules saved per
+        # switch, or None if merging does not save rules
+        separate = defaultdict(set)
+        for invariant in group:
+            dfa_rules, _ = self.rule_parts[invariant.id]
+            for sw_name, rules_list in dfa_rules.items():
+                separate[sw_name] |= self._entries(rules_list)
+        union = PacketSetUnion(invariant.packet_set for invariant in group)
+        shared = self._encode(group[0].get_dfa_rules(topo, list(union)))
+        saved = dict()
+        for sw_name in set(separate.keys()) | set(shared.keys()):
+            num_shared = len(self._entries(shared.get(sw_name, [])))
+            saved[sw_name] = len(separate.get(sw_name, ())) - num_shared
+        if min(saved.values()) < 0 or sum(saved.values()) <= 0:
+            return None
+        return shared, saved
+
+    def merge(self, invariants, topo, compiled):
+        """
+        Merges the groups of the invariants, whose DFAs are constructed.
+        compiled has the encoded rule parts (invariant ID -> parts) of the
+        invariants that have just been compiled; the others keep theirs from
+        the previous passes. Returns the rules (invariant ID -> switch ->
+        rules) of the compiled invariants, and of the other invariants whose
+        rules change: those of the merged groups that changed, and those that
+        are no longer merged.
+        """
+        # The rule parts of the removed invariants are dropped
+        rule_parts = dict()
+        for invariant in invariants:
+            rule_parts[invariant.id] = self.rule_parts.get(invariant.id)
+        rule_parts.update(compiled)
+        self.rule_parts = rule_parts
+        groups = defaultdict(list) # canonical DFA key -> [ invariants ]
+        for invariant in invariants:
+            if isinstance(invariant, RegexInvariant) and invariant.dfa != None:
+                groups[invariant.dfa.canonical_key()].append(invariant)
+
+        rules = {
+            inv_id: _join_rules(*rule_parts)
+            for inv_id, rule_parts in compiled.items()
+        }
+        signatures = dict()
+        merged = set()
+        saved = dict()
+        for key, group in groups.items():
+            group.sort(key=lambda invariant: invariant.id)
+            ids = tuple(invariant.id for invariant in group)
+            unchanged = True
+            for inv_id in ids:
+                signatures[inv_id] = (key, ids)
+                if (self.signatures.get(inv_id) != (key, ids) or
+                        inv_id in compiled):
+                    unchanged = False
+            if len(ids) < 2:
+                continue
+            if unchanged:
+                # Unchanged group, whose rules are already installed
+                if key in self.saved:
+                    merged.update(ids)
+                    saved[key] = self.saved[key]
+                continue
+            result = self._merge_group(group, topo)
+            if result == None:
+                continue
+            shared, saved[key] = result
+            merged.update(ids)
+            for inv_id in ids:
+                _, violation_rules = self.rule_parts[inv_id]
+                rules[inv_id] = _join_rules(shared, violation_rules)
+
+        # The invariants that are no longer merged get their own rules back
+        for inv_id in self.merged - merged:
+            if inv_id in self.rule_parts and inv_id not in compiled:
+                rules[inv_id] = _join_rules(*self.rule_parts[inv_id])
+
+        self.signatures = signatures
+        self.merged = merged
+        self.saved = saved
+        self._report()
+        return rules
+
+    def saved_rules(self):
+        "Rules saved per switch by the merged groups"
+        saved = defaultdict(int)
+        for group_saved in self.saved.values():
+            for sw_name, num_saved in group_saved.items():
+                saved[sw_name] += num_saved
+        return dict(saved)
+
+    def _report(self):
+        saved = self.saved_rules()
+        print('DFA groups: {} merged ({} invariants), {} rules saved'.format(
+            len(self.saved), len(self.merged), sum(saved.values())))
+        if len(saved) > 0:
+            per_switch = [
+                '{} {}'.format(sw_name, num_saved)
+                for sw_name, num_saved in sorted(saved.items())
+            ]
+            print('Rules saved per switch:', ', '.join(per_switch))
+
+
+# Topology, DFA cache and range encoder of the current compiler worker (see
+# compile_invariants)
+_worker_topology = None
+_worker_dfa_cache = None
+_worker_range_encoder = None
+
+
+def _init_compiler_worker(topo, dfa_cache, range_encoder):
+    global _worker_topology, _worker_dfa_cache, _worker_range_encoder
+    _worker_topology = topo
+    _worker_dfa_cache = dfa_cache
+    _worker_range_encoder = range_encoder
+
+
+def compile_invariant(invariant, topo, dfa_cache=None, range_encoder=None):
+    "Encoded rule parts of an invariant (see Invariant.get_rule_parts)"
+    rule_parts = invariant.get_rule_parts(topo, dfa_cache)
+    if range_encoder != None:
+        rule_parts = range_encoder.encode_invariant(invariant, rule_parts)
+    return tuple(dict(rules) for rules in rule_parts)
+
+
+def _compile_invariant(invariant):
+    start = time.perf_counter()
+    rule_parts = compile_invariant(invariant, _worker_topology,
+                                   _worker_dfa_cache, _worker_range_encoder)
+    end = time.perf_counter()
+    # The DFA is sent back to be updated on topology changes
+    return rule_parts, end - start, getattr(invariant, 'dfa', None)
+
+
+def compile_invariants(invariants,
+                       topo,
+                       max_workers=None,
+                       dfa_cache=None,
+                       range_encoder=None):
+    """
+    Compile the rules of all the invariants in a pool of worker processes, since
+    the regex and DFA construction is CPU-bound. The topology is sent once to
+    each worker rather than once per invariant. Returns a list of (rule parts,
+    compile time) tuples in the same order as `invariants` (see
+    compile_invariant).
+    """
+    if max_workers == 1 or len(invariants) <= 1:
+        _init_compiler_worker(topo, dfa_cache, range_encoder)
+        results = [_compile_invariant(inv) for inv in invariants]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_compiler_worker,
+                                 initargs=(topo, dfa_cache,
+                                           range_encoder)) as executor:
+            results = list(executor.map(_compile_invariant, invariants))
+
+    for invariant, (_, _, dfa) in zip(invariants, results):
+        if dfa != None:
+            dfa.set_topology(topo)
+            invariant.dfa = dfa
+    return [
+        (rule_parts, compile_time) for rule_parts, compile_time, _ in results
+    ]
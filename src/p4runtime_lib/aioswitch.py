@@ -0,0 +1,63 @@
+#
+# asyncio variant of the P4Runtime stream channel of SwitchConnection, based on
+# grpc.aio. The stream messages of all the switches are read by tasks of a
+# single event loop instead of one blocked thread per switch.
+#
+import grpc
+import grpc.aio
+from p4.v1 import p4runtime_pb2
+from p4.v1 import p4runtime_pb2_grpc
+
+from .switch import MAX_METADATA_SIZE
+
+
+class AioSwitchConnection(object):
+    """Owns the StreamChannel (and thus the mastership) of a switch. It must be
+    created in the event loop that reads it. The other RPCs can still be sent
+    by a SwitchConnection created with stream=False and the same election ID."""
+
+    def __init__(self, name=None, address='127.0.0.1:50051', device_id=0):
+        self.name = name
+        self.address = address
+        self.device_id = device_id
+        options = [('grpc.max_metadata_size', MAX_METADATA_SIZE)]
+        self.channel = grpc.aio.insecure_channel(self.address, options=options)
+        self.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        self.stream = self.client_stub.StreamChannel()
+
+    async def shutdown(self):
+        self.stream.cancel()
+        await self.channel.close()
+
+    async def MasterArbitrationUpdate(self, dry_run=False, **kwargs):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.arbitration.device_id = self.device_id
+        request.arbitration.election_id.high = 0
+        request.arbitration.election_id.low = 1
+
+        if dry_run:
+            print("P4Runtime MasterArbitrationUpdate: ", request)
+        else:
+            await self.stream.write(request)
+            return await self.stream.read() # just one
+
+    async def PacketOut(self, packet, dry_run=False, **kwargs):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.packet.CopyFrom(packet)
+        if dry_run:
+            print("P4Runtime PacketOut: ", request)
+        else:
+            await self.stream.write(request)
+
+    async def StreamMessages(self):
+        # Yields the StreamMessageResponses until the stream is closed
+        while True:
+            response = await self.stream.read()
+            if response == grpc.aio.EOF:
+                return
+            yield response
+
+    async def PacketIns(self):
+        async for response in self.StreamMessages():
+            if response.WhichOneof('update') == 'packet':
+                yield response.packet
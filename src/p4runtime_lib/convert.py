@@ -15,6 +15,7 @@
 import re
 import socket
 import math
+from functools import lru_cache
 '''
 This package contains several helper functions for encoding to and decoding from byte strings:
 - integers
@@ -57,38 +58,63 @@ def bitwidthToBytes(bitwidth):
 
 
 def encodeNum(number, bitwidth):
-    byte_len = bitwidthToBytes(bitwidth)
-    num_str = '%x' % number
     if number >= 2**bitwidth:
         raise Exception("Number, %d, does not fit in %d bits" %
                         (number, bitwidth))
-    return bytes.fromhex('0' * (byte_len * 2 - len(num_str)) + num_str)
+    return number.to_bytes(bitwidthToBytes(bitwidth), 'big')
 
 
 def decodeNum(encoded_number):
-    return int(encoded_number.hex(), 16)
+    return int.from_bytes(encoded_number, 'big')
 
 
-def encode(x, bitwidth):
-    'Tries to infer the type of `x` and encode it'
+# Number of distinct strings (addresses) whose encoding is memoized
+STRING_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=STRING_CACHE_SIZE)
+def encodeString(x):
+    'Encodes a MAC or IPv4 address string'
+    if matchesIPv4(x):
+        return encodeIPv4(x)
+    elif matchesMac(x):
+        return encodeMac(x)
+    else:
+        # Assume that the string is already encoded
+        return x
+
+
+@lru_cache(maxsize=None)
+def getEncoder(bitwidth):
+    '''
+    Returns an encoder of values of the given bitwidth, which is equivalent to
+    encode(x, bitwidth) with the type checks and sizes resolved in advance. It
+    is meant to be bound to a match field or action param once.
+    '''
     byte_len = bitwidthToBytes(bitwidth)
-    if (type(x) == list or type(x) == tuple) and len(x) == 1:
-        x = x[0]
-    encoded_bytes = None
-    if type(x) == str:
-        if matchesMac(x):
-            encoded_bytes = encodeMac(x)
-        elif matchesIPv4(x):
-            encoded_bytes = encodeIPv4(x)
+    limit = 2**bitwidth
+
+    def encodeValue(x):
+        if (type(x) == list or type(x) == tuple) and len(x) == 1:
+            x = x[0]
+        if type(x) == int:
+            if x >= limit:
+                raise Exception("Number, %d, does not fit in %d bits" %
+                                (x, bitwidth))
+            return x.to_bytes(byte_len, 'big')
+        elif type(x) == str:
+            encoded_bytes = encodeString(x)
         else:
-            # Assume that the string is already encoded
-            encoded_bytes = x
-    elif type(x) == int:
-        encoded_bytes = encodeNum(x, bitwidth)
-    else:
-        raise Exception("Encoding objects of %r is not supported" % type(x))
-    assert (len(encoded_bytes) == byte_len)
-    return encoded_bytes
+            raise Exception("Encoding objects of %r is not supported" % type(x))
+        assert (len(encoded_bytes) == byte_len)
+        return encoded_bytes
+
+    return encodeValue
+
+
+def encode(x, bitwidth):
+    'Tries to infer the type of `x` and encode it'
+    return getEncoder(bitwidth)(x)
 
 
 if __name__ == '__main__':
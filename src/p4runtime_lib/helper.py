@@ -18,7 +18,7 @@ import google.protobuf.text_format
 from p4.v1 import p4runtime_pb2
 from p4.config.v1 import p4info_pb2
 
-from .convert import encode
+from .convert import getEncoder
 
 
 class P4InfoHelper(object):
@@ -29,19 +29,56 @@ class P4InfoHelper(object):
         with open(p4_info_filepath) as p4info_f:
             google.protobuf.text_format.Merge(p4info_f.read(), p4info)
         self.p4info = p4info
+        self._buildIndexes()
+
+    def _buildIndexes(self):
+        # Hash indexes of the P4Info entities, so that lookups do not scan the
+        # P4Info. When several entities match, the first one is kept, as the
+        # linear scans did.
+        self.by_name = {} # entity type -> name or alias -> entity
+        self.by_id = {} # entity type -> id -> entity
+        for field in self.p4info.DESCRIPTOR.fields:
+            if (field.label != field.LABEL_REPEATED or
+                    field.message_type is None or
+                    'preamble' not in field.message_type.fields_by_name):
+                continue
+            by_name = self.by_name[field.name] = {}
+            by_id = self.by_id[field.name] = {}
+            for o in getattr(self.p4info, field.name):
+                pre = o.preamble
+                by_name.setdefault(pre.name, o)
+                by_name.setdefault(pre.alias, o)
+                by_id.setdefault(pre.id, o)
+
+        # The value encoders are bound to the fields by their bitwidths
+        self.match_fields = {} # (table name, field name or id) -> MatchField
+        self.match_field_encoders = {} # (table name, field name) -> encoder
+        for t in self.p4info.tables:
+            for mf in t.match_fields:
+                self.match_fields.setdefault((t.preamble.name, mf.name), mf)
+                self.match_fields.setdefault((t.preamble.name, mf.id), mf)
+                self.match_field_encoders.setdefault((t.preamble.name, mf.name),
+                                                     getEncoder(mf.bitwidth))
+
+        self.action_params = {} # (action name, param name or id) -> Param
+        self.action_param_encoders = {} # (action name, param name) -> encoder
+        for a in self.p4info.actions:
+            for p in a.params:
+                self.action_params.setdefault((a.preamble.name, p.name), p)
+                self.action_params.setdefault((a.preamble.name, p.id), p)
+                self.action_param_encoders.setdefault((a.preamble.name, p.name),
+                                                      getEncoder(p.bitwidth))
 
     def get(self, entity_type, name=None, id=None):
         if name is not None and id is not None:
             raise AssertionError("name or id must be None")
 
-        for o in getattr(self.p4info, entity_type):
-            pre = o.preamble
-            if name:
-                if (pre.name == name or pre.alias == name):
-                    return o
-            else:
-                if pre.id == id:
-                    return o
+        if name:
+            o = self.by_name.get(entity_type, {}).get(name)
+        else:
+            o = self.by_id.get(entity_type, {}).get(id)
+        if o is not None:
+            return o
 
         if name:
             raise AttributeError("Could not find %r of type %s" %
@@ -62,32 +99,33 @@ class P4InfoHelper(object):
     def __getattr__(self, attr):
         # Synthesize convenience functions for name to id lookups for top-level entities
         # e.g. get_tables_id(name_string) or get_actions_id(name_string)
+        # The functions are cached as attributes, so that this is only called
+        # once per function
         m = re.search("^get_(\w+)_id$", attr)
         if m:
             primitive = m.group(1)
-            return lambda name: self.get_id(primitive, name)
+            func = lambda name: self.get_id(primitive, name)
+            setattr(self, attr, func)
+            return func
 
         # Synthesize convenience functions for id to name lookups
         # e.g. get_tables_name(id) or get_actions_name(id)
         m = re.search("^get_(\w+)_name$", attr)
         if m:
             primitive = m.group(1)
-            return lambda id: self.get_name(primitive, id)
+            func = lambda id: self.get_name(primitive, id)
+            setattr(self, attr, func)
+            return func
 
         raise AttributeError("%r object has no attribute %r" %
                              (self.__class__, attr))
 
     def get_match_field(self, table_name, name=None, id=None):
-        for t in self.p4info.tables:
-            pre = t.preamble
-            if pre.name == table_name:
-                for mf in t.match_fields:
-                    if name is not None:
-                        if mf.name == name:
-                            return mf
-                    elif id is not None:
-                        if mf.id == id:
-                            return mf
+        key = name if name is not None else id
+        if key is not None:
+            mf = self.match_fields.get((table_name, key))
+            if mf is not None:
+                return mf
         raise AttributeError("%r has no attribute %r" %
                              (table_name, name if name is not None else id))
 
@@ -99,25 +137,25 @@ class P4InfoHelper(object):
 
     def get_match_field_pb(self, table_name, match_field_name, value):
         p4info_match = self.get_match_field(table_name, match_field_name)
-        bitwidth = p4info_match.bitwidth
+        encode = self.match_field_encoders[(table_name, match_field_name)]
         p4runtime_match = p4runtime_pb2.FieldMatch()
         p4runtime_match.field_id = p4info_match.id
         match_type = p4info_match.match_type
         if match_type == p4info_pb2.MatchField.EXACT:
             exact = p4runtime_match.exact
-            exact.value = encode(value, bitwidth)
+            exact.value = encode(value)
         elif match_type == p4info_pb2.MatchField.LPM:
             lpm = p4runtime_match.lpm
-            lpm.value = encode(value[0], bitwidth)
+            lpm.value = encode(value[0])
             lpm.prefix_len = value[1]
         elif match_type == p4info_pb2.MatchField.TERNARY:
             lpm = p4runtime_match.ternary
-            lpm.value = encode(value[0], bitwidth)
-            lpm.mask = encode(value[1], bitwidth)
+            lpm.value = encode(value[0])
+            lpm.mask = encode(value[1])
         elif match_type == p4info_pb2.MatchField.RANGE:
             lpm = p4runtime_match.range
-            lpm.low = encode(value[0], bitwidth)
-            lpm.high = encode(value[1], bitwidth)
+            lpm.low = encode(value[0])
+            lpm.high = encode(value[1])
         else:
             raise Exception("Unsupported match type with type %r" % match_type)
         return p4runtime_match
@@ -138,19 +176,15 @@ class P4InfoHelper(object):
             raise Exception("Unsupported match type with type %r" % match_type)
 
     def get_action_param(self, action_name, name=None, id=None):
-        for a in self.p4info.actions:
-            pre = a.preamble
-            if pre.name == action_name:
-                for p in a.params:
-                    if name is not None:
-                        if p.name == name:
-                            return p
-                    elif id is not None:
-                        if p.id == id:
-                            return p
-        raise AttributeError(
-            "action %r has no param %r, (has: %r)" %
-            (action_name, name if name is not None else id, a.params))
+        key = name if name is not None else id
+        if key is not None:
+            p = self.action_params.get((action_name, key))
+            if p is not None:
+                return p
+        a = self.by_name['actions'].get(action_name)
+        raise AttributeError("action %r has no param %r, (has: %r)" %
+                             (action_name, name if name is not None else id,
+                              a.params if a is not None else []))
 
     def get_action_param_id(self, action_name, param_name):
         return self.get_action_param(action_name, name=param_name).id
@@ -160,9 +194,10 @@ class P4InfoHelper(object):
 
     def get_action_param_pb(self, action_name, param_name, value):
         p4info_param = self.get_action_param(action_name, param_name)
+        encode = self.action_param_encoders[(action_name, param_name)]
         p4runtime_param = p4runtime_pb2.Action.Param()
         p4runtime_param.param_id = p4info_param.id
-        p4runtime_param.value = encode(value, p4info_param.bitwidth)
+        p4runtime_param.value = encode(value)
         return p4runtime_param
 
     # get replicas
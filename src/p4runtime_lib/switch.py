@@ -12,17 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from queue import Queue
+import time
+import atexit
+import struct
+import threading
+from queue import Queue, Full
 from abc import abstractmethod
 from datetime import datetime
 
 import grpc
+from google.protobuf import text_format
 from p4.v1 import p4runtime_pb2
 from p4.v1 import p4runtime_pb2_grpc
 from p4.tmp import p4config_pb2
 
+from .error_utils import parseGrpcErrorBinaryDetails
+from .wire import encodeLenField, encodeVarintField
+
 MSG_LOG_MAX_LEN = 1024
 
+# Request log modes (see GrpcRequestLogger)
+LOG_TEXT = 'text'
+LOG_BINARY = 'binary'
+LOG_OFF = 'off'
+LOG_MODES = [LOG_TEXT, LOG_BINARY, LOG_OFF]
+
+# Maximum number of requests waiting to be logged
+LOG_MAX_PENDING = 4096
+
+# Messages of the requests that are sent serialized (see WriteEncodedUpdates),
+# by method, to log them as text
+SERIALIZED_REQUESTS = {
+    '/p4.v1.P4Runtime/Write': p4runtime_pb2.WriteRequest,
+}
+
+# Default number of updates packed into a single WriteRequest
+WRITE_BATCH_SIZE = 128
+
+# The per-update errors of a failed batch are returned in the trailing metadata,
+# which easily exceeds the default 8 KiB limit of gRPC for large batches
+MAX_METADATA_SIZE = 1024 * 1024
+
 # List of all active connections
 connections = []
 
@@ -38,19 +68,35 @@ class SwitchConnection(object):
                  name=None,
                  address='127.0.0.1:50051',
                  device_id=0,
-                 proto_dump_file=None):
+                 proto_dump_file=None,
+                 log_mode=LOG_TEXT,
+                 log_sample_every=1,
+                 stream=True):
         self.name = name
         self.address = address
         self.device_id = device_id
         self.p4info = None
-        self.channel = grpc.insecure_channel(self.address)
-        if proto_dump_file is not None:
-            interceptor = GrpcRequestLogger(proto_dump_file)
-            self.channel = grpc.intercept_channel(self.channel, interceptor)
+        self.channel = grpc.insecure_channel(self.address,
+                                             options=[('grpc.max_metadata_size',
+                                                       MAX_METADATA_SIZE)])
+        self.request_logger = None
+        if proto_dump_file is not None and log_mode != LOG_OFF:
+            self.request_logger = GrpcRequestLogger(
+                proto_dump_file, mode=log_mode, sample_every=log_sample_every)
+            self.channel = grpc.intercept_channel(self.channel,
+                                                  self.request_logger)
         self.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        # Write RPC taking an already serialized WriteRequest
+        self.encoded_write = self.channel.unary_unary(
+            '/p4.v1.P4Runtime/Write',
+            response_deserializer=p4runtime_pb2.WriteResponse.FromString)
+        # Without the stream, the mastership is held by another connection
+        # (e.g., an AioSwitchConnection) with the same election ID
         self.requests_stream = IterableQueue()
-        self.stream_msg_resp = self.client_stub.StreamChannel(
-            iter(self.requests_stream))
+        self.stream_msg_resp = None
+        if stream:
+            self.stream_msg_resp = self.client_stub.StreamChannel(
+                iter(self.requests_stream))
         self.proto_dump_file = proto_dump_file
         connections.append(self)
 
@@ -60,7 +106,10 @@ class SwitchConnection(object):
 
     def shutdown(self):
         self.requests_stream.close()
-        self.stream_msg_resp.cancel()
+        if self.stream_msg_resp is not None:
+            self.stream_msg_resp.cancel()
+        if self.request_logger is not None:
+            self.request_logger.close()
 
     def MasterArbitrationUpdate(self, dry_run=False, **kwargs):
         request = p4runtime_pb2.StreamMessageRequest()
@@ -75,7 +124,11 @@ class SwitchConnection(object):
             for item in self.stream_msg_resp:
                 return item # just one
 
-    def SetForwardingPipelineConfig(self, p4info, dry_run=False, **kwargs):
+    def SetForwardingPipelineConfig(self,
+                                    p4info,
+                                    dry_run=False,
+                                    cookie=None,
+                                    **kwargs):
         device_config = self.buildDeviceConfig(**kwargs)
         request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
         request.election_id.low = 1
@@ -84,6 +137,9 @@ class SwitchConnection(object):
 
         config.p4info.CopyFrom(p4info)
         config.p4_device_config = device_config.SerializeToString()
+        # The cookie identifies the pipeline, see GetForwardingPipelineCookie
+        if cookie is not None:
+            config.cookie.cookie = cookie
 
         request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
         if dry_run:
@@ -91,6 +147,25 @@ class SwitchConnection(object):
         else:
             self.client_stub.SetForwardingPipelineConfig(request)
 
+    # Returns the cookie of the installed pipeline, or None if there is no
+    # pipeline or it was installed without a cookie
+    def GetForwardingPipelineCookie(self, dry_run=False):
+        request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+        request.device_id = self.device_id
+        request.response_type = p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+        if dry_run:
+            print("P4Runtime GetForwardingPipelineConfig:", request)
+            return None
+        try:
+            response = self.client_stub.GetForwardingPipelineConfig(request)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.FAILED_PRECONDITION: # no pipeline
+                return None
+            raise
+        if not response.config.HasField('cookie'):
+            return None
+        return response.config.cookie.cookie
+
     def WriteTableEntry(self, table_entry, dry_run=False):
         request = p4runtime_pb2.WriteRequest()
         request.device_id = self.device_id
@@ -106,6 +181,94 @@ class SwitchConnection(object):
         else:
             self.client_stub.Write(request)
 
+    # Batched write: pack up to `batch_size` updates into each WriteRequest.
+    # Returns a list of (index, p4.Error) tuples, where the index refers to the
+    # position of the failed entry in `table_entries`. Errors without binary
+    # details cannot be attributed to an update and are re-raised as is.
+    def WriteTableEntries(self,
+                          table_entries,
+                          batch_size=WRITE_BATCH_SIZE,
+                          dry_run=False):
+        if batch_size < 1:
+            raise ValueError('Invalid batch size: {}'.format(batch_size))
+        errors = []
+        for offset in range(0, len(table_entries), batch_size):
+            request = p4runtime_pb2.WriteRequest()
+            request.device_id = self.device_id
+            request.election_id.low = 1
+            for table_entry in table_entries[offset:offset + batch_size]:
+                update = request.updates.add()
+                if table_entry.is_default_action:
+                    update.type = p4runtime_pb2.Update.MODIFY
+                else:
+                    update.type = p4runtime_pb2.Update.INSERT
+                update.entity.table_entry.CopyFrom(table_entry)
+            if dry_run:
+                print("P4Runtime Write:", request)
+                continue
+            try:
+                self.client_stub.Write(request)
+            except grpc.RpcError as e:
+                p4_errors = parseGrpcErrorBinaryDetails(e)
+                if p4_errors is None:
+                    raise
+                errors += [
+                    (offset + idx, p4_error) for idx, p4_error in p4_errors
+                ]
+        return errors
+
+    # Same as WriteTableEntries, but for serialized TableEntry messages (see
+    # TableEntryEncoder), which are framed into the WriteRequests as they are.
+    # All the updates are INSERTs.
+    def WriteEncodedTableEntries(self,
+                                 encoded_entries,
+                                 batch_size=WRITE_BATCH_SIZE,
+                                 dry_run=False):
+        insert = p4runtime_pb2.Update.INSERT
+        return self.WriteEncodedUpdates(
+            [(insert, entry) for entry in encoded_entries], batch_size, dry_run)
+
+    # Batched write of (update type, serialized TableEntry) tuples. Returns
+    # the errors like WriteTableEntries.
+    def WriteEncodedUpdates(self,
+                            updates,
+                            batch_size=WRITE_BATCH_SIZE,
+                            dry_run=False):
+        if batch_size < 1:
+            raise ValueError('Invalid batch size: {}'.format(batch_size))
+        header = p4runtime_pb2.WriteRequest()
+        header.device_id = self.device_id
+        header.election_id.low = 1
+        header = header.SerializeToString()
+        update_types = {}
+        errors = []
+        for offset in range(0, len(updates), batch_size):
+            # WriteRequest.updates: Update { type, entity { table_entry } }
+            encoded = []
+            for update_type, entry in updates[offset:offset + batch_size]:
+                if update_type not in update_types:
+                    update_types[update_type] = encodeVarintField(
+                        1, update_type)
+                encoded.append(
+                    encodeLenField(
+                        4, update_types[update_type] +
+                        encodeLenField(2, encodeLenField(2, entry))))
+            request = header + b''.join(encoded)
+            if dry_run:
+                print("P4Runtime Write:",
+                      p4runtime_pb2.WriteRequest.FromString(request))
+                continue
+            try:
+                self.encoded_write(request)
+            except grpc.RpcError as e:
+                p4_errors = parseGrpcErrorBinaryDetails(e)
+                if p4_errors is None:
+                    raise
+                errors += [
+                    (offset + idx, p4_error) for idx, p4_error in p4_errors
+                ]
+        return errors
+
     # Delete
     def DeleteTableEntry(self, table_entry, dry_run=False):
         request = p4runtime_pb2.WriteRequest()
@@ -210,11 +373,10 @@ class SwitchConnection(object):
             #    return item
 
     def PacketIn(self, dry_run=False, **kwargs):
-        request = p4runtime_pb2.StreamMessageRequest()
+        # Waits for the next stream message; nothing needs to be sent
         if dry_run:
-            print("P4Runtime PacketIn: ", request)
+            print("P4Runtime PacketIn")
         else:
-            self.requests_stream.put(request)
             for item in self.stream_msg_resp:
                 return item
 
@@ -254,25 +416,98 @@ class SwitchConnection(object):
 
 class GrpcRequestLogger(grpc.UnaryUnaryClientInterceptor,
                         grpc.UnaryStreamClientInterceptor):
-    """Implementation of a gRPC interceptor that logs request to a file"""
+    """Implementation of a gRPC interceptor that logs request to a file.
+
+    The requests are queued and written by a background thread, which keeps the
+    file open and flushes it when the queue is drained, so logging does not
+    block the RPCs. In LOG_TEXT mode the requests are written as text, and in
+    LOG_BINARY mode as records of:
+        timestamp (double), method length (uint16), message length (uint32),
+        method, serialized message
+    in network byte order. Only one in `sample_every` requests is logged, and
+    requests are dropped (and counted) while `max_pending` are queued.
+    """
 
-    def __init__(self, log_file):
+    def __init__(self,
+                 log_file,
+                 mode=LOG_TEXT,
+                 sample_every=1,
+                 max_pending=LOG_MAX_PENDING):
+        if mode not in (LOG_TEXT, LOG_BINARY):
+            raise ValueError('Invalid log mode: {}'.format(mode))
+        if sample_every < 1:
+            raise ValueError('Invalid sampling: {}'.format(sample_every))
         self.log_file = log_file
-        with open(self.log_file, 'w') as f:
-            # Clear content if it exists.
-            f.write("")
+        self.mode = mode
+        self.sample_every = sample_every
+        self.num_requests = 0
+        self.num_dropped = 0
+        # Clear content if it exists.
+        self.file = open(self.log_file, 'w' if mode == LOG_TEXT else 'wb')
+        self.pending = Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self._write_messages, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
     def log_message(self, method_name, body):
-        with open(self.log_file, 'a') as f:
-            ts = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-            msg = str(body)
-            f.write("\n[%s] %s\n---\n" % (ts, method_name))
+        self.num_requests += 1
+        if self.num_requests % self.sample_every != 0:
+            return
+        try:
+            self.pending.put_nowait((time.time(), method_name, body))
+        except Full:
+            self.num_dropped += 1
+
+    def _format_message(self, ts, method_name, body):
+        if self.mode == LOG_BINARY:
+            if not isinstance(body, bytes):
+                body = body.SerializeToString()
+            method = method_name.encode('utf-8')
+            return (struct.pack('!dHI', ts, len(method), len(body)) + method +
+                    body)
+
+        ts = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        if isinstance(body, bytes):
+            # Parsed here rather than by the caller, off the RPC path
+            message_cls = SERIALIZED_REQUESTS.get(method_name)
+            if message_cls is None:
+                body = "Serialized message (%d bytes)\n" % len(body)
+            else:
+                body = message_cls.FromString(body)
+        if (isinstance(body, p4runtime_pb2.WriteRequest) and
+                len(body.updates) > 1):
+            # The updates of a batch are logged one by one, since the whole
+            # batch is usually too long
+            msgs = ["device_id: %d\n" % body.device_id]
+            for update in body.updates:
+                update = text_format.MessageToString(update, indent=2)
+                msgs.append("updates {\n%s}\n" % update)
+        else:
+            msgs = [str(body)]
+        text = "\n[%s] %s\n---\n" % (ts, method_name)
+        for msg in msgs:
             if len(msg) < MSG_LOG_MAX_LEN:
-                f.write(str(body))
+                text += msg
             else:
-                f.write("Message too long (%d bytes)! Skipping log...\n" %
-                        len(msg))
-            f.write('---\n')
+                text += "Message too long (%d bytes)! Skipping log...\n" % (
+                    len(msg))
+        return text + '---\n'
+
+    def _write_messages(self):
+        while True:
+            message = self.pending.get()
+            if message is None:
+                break
+            self.file.write(self._format_message(*message))
+            if self.pending.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        # Write the pending messages and close the file
+        if self.writer.is_alive():
+            self.pending.put(None)
+            self.writer.join()
 
     def intercept_unary_unary(self, continuation, client_call_details, request):
         self.log_message(client_call_details.method, request)
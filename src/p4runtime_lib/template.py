@@ -0,0 +1,162 @@
+#
+# Compiled encoders of P4Runtime table entries. The IDs, match types and
+# bitwidths of a table entry shape are resolved from the P4Info once, and the
+# entries are emitted directly as serialized TableEntry messages (see
+# SwitchConnection.WriteEncodedTableEntries).
+#
+from p4.v1 import p4runtime_pb2
+from p4.config.v1 import p4info_pb2
+
+from .wire import encodeLenField, encodeVarintField
+
+FieldMatch = p4runtime_pb2.FieldMatch
+
+
+def _fieldNumber(message, field_name):
+    return message.DESCRIPTOR.fields_by_name[field_name].number
+
+
+# Maximum number of encoded values memoized per match field or action param
+CACHE_SIZE = 4096
+
+TABLE_ID = _fieldNumber(p4runtime_pb2.TableEntry, 'table_id')
+MATCH = _fieldNumber(p4runtime_pb2.TableEntry, 'match')
+ACTION = _fieldNumber(p4runtime_pb2.TableEntry, 'action')
+PRIORITY = _fieldNumber(p4runtime_pb2.TableEntry, 'priority')
+FIELD_ID = _fieldNumber(FieldMatch, 'field_id')
+TABLE_ACTION = _fieldNumber(p4runtime_pb2.TableAction, 'action')
+ACTION_ID = _fieldNumber(p4runtime_pb2.Action, 'action_id')
+PARAMS = _fieldNumber(p4runtime_pb2.Action, 'params')
+PARAM_ID = _fieldNumber(p4runtime_pb2.Action.Param, 'param_id')
+PARAM_VALUE = _fieldNumber(p4runtime_pb2.Action.Param, 'value')
+
+# Match type -> FieldMatch field. The value (or low) of all these fields is field
+# 1, and the prefix length, mask (or high) is field 2.
+MATCH_TYPES = {
+    p4info_pb2.MatchField.EXACT: _fieldNumber(FieldMatch, 'exact'),
+    p4info_pb2.MatchField.LPM: _fieldNumber(FieldMatch, 'lpm'),
+    p4info_pb2.MatchField.TERNARY: _fieldNumber(FieldMatch, 'ternary'),
+    p4info_pb2.MatchField.RANGE: _fieldNumber(FieldMatch, 'range'),
+}
+
+
+class TableEntryTemplate(object):
+    """Encoder of the table entries with the given table, match field names,
+    action and action param names (in this order)"""
+
+    def __init__(self, p4info_helper, table_name, match_field_names,
+                 action_name, action_param_names):
+        self.table_id = encodeVarintField(
+            TABLE_ID, p4info_helper.get_tables_id(table_name))
+
+        self.match_fields = []
+        for name in match_field_names:
+            p4info_match = p4info_helper.get_match_field(table_name, name)
+            match_type = p4info_match.match_type
+            if match_type not in MATCH_TYPES:
+                raise Exception("Unsupported match type with type %r" %
+                                match_type)
+            field_id = encodeVarintField(FIELD_ID, p4info_match.id)
+            encoder = p4info_helper.match_field_encoders[(table_name, name)]
+            self.match_fields.append((field_id, match_type, encoder, {}))
+
+        self.action_id = None
+        self.action_params = []
+        if action_name:
+            self.action_id = encodeVarintField(
+                ACTION_ID, p4info_helper.get_actions_id(action_name))
+            for name in action_param_names:
+                p4info_param = p4info_helper.get_action_param(action_name, name)
+                param_id = encodeVarintField(PARAM_ID, p4info_param.id)
+                encoder = p4info_helper.action_param_encoders[(action_name,
+                                                               name)]
+                self.action_params.append((param_id, encoder, {}))
+
+    @staticmethod
+    def _cached(cache, value, encoder):
+        # The same values (e.g., the packet set of an invariant, or the DFA
+        # states) recur across many entries
+        key = tuple(value) if type(value) == list else value
+        try:
+            encoded = cache.get(key)
+        except TypeError: # unhashable
+            return encoder(value)
+        if encoded is None:
+            if len(cache) >= CACHE_SIZE:
+                cache.clear()
+            encoded = encoder(value)
+            cache[key] = encoded
+        return encoded
+
+    @staticmethod
+    def encodeMatch(field, value):
+        field_id, match_type, encode, _ = field
+        if match_type == p4info_pb2.MatchField.EXACT:
+            match = encodeLenField(1, encode(value))
+        elif match_type == p4info_pb2.MatchField.LPM:
+            match = (encodeLenField(1, encode(value[0])) +
+                     encodeVarintField(2, value[1]))
+        else:
+            match = (encodeLenField(1, encode(value[0])) +
+                     encodeLenField(2, encode(value[1])))
+        return encodeLenField(
+            MATCH, field_id + encodeLenField(MATCH_TYPES[match_type], match))
+
+    @staticmethod
+    def encodeParam(param, value):
+        param_id, encode, _ = param
+        return encodeLenField(
+            PARAMS, param_id + encodeLenField(PARAM_VALUE, encode(value)))
+
+    def encode(self, match_values=(), action_values=(), priority=None):
+        "Returns the serialized TableEntry"
+        encoded = [self.table_id]
+        for field, value in zip(self.match_fields, match_values):
+            encoded.append(
+                self._cached(field[3], value,
+                             lambda v: self.encodeMatch(field, v)))
+        if self.action_id is not None:
+            action = [self.action_id]
+            for param, value in zip(self.action_params, action_values):
+                action.append(
+                    self._cached(param[2], value,
+                                 lambda v: self.encodeParam(param, v)))
+            encoded.append(
+                encodeLenField(ACTION,
+                               encodeLenField(TABLE_ACTION, b''.join(action))))
+        if priority is not None:
+            encoded.append(encodeVarintField(PRIORITY, priority))
+        return b''.join(encoded)
+
+
+class TableEntryEncoder(object):
+    """Serializes table entries like P4InfoHelper.buildTableEntry does, with a
+    TableEntryTemplate per entry shape"""
+
+    def __init__(self, p4info_helper):
+        self.p4info_helper = p4info_helper
+        self.templates = {}
+
+    def getTemplate(self, table_name, match_field_names, action_name,
+                    action_param_names):
+        key = (table_name, match_field_names, action_name, action_param_names)
+        template = self.templates.get(key)
+        if template is None:
+            template = TableEntryTemplate(self.p4info_helper, table_name,
+                                          match_field_names, action_name,
+                                          action_param_names)
+            self.templates[key] = template
+        return template
+
+    def encodeTableEntry(self,
+                         table_name,
+                         match_fields=None,
+                         action_name=None,
+                         action_params=None,
+                         priority=None):
+        match_fields = match_fields or {}
+        action_params = action_params or {}
+        template = self.getTemplate(table_name, tuple(match_fields),
+                                    action_name, tuple(action_params))
+        return template.encode(match_fields.values(), action_params.values(),
+                               priority)
@@ -0,0 +1,34 @@
+#
+# Minimal encoder of the protobuf wire format, used to emit pre-serialized
+# P4Runtime messages without building Python protobuf objects. Concatenating
+# the fields of a message in field number order yields the same bytes as
+# SerializeToString().
+#
+VARINT = 0
+LEN = 2
+
+
+def encodeVarint(number):
+    if number < 0:
+        number &= (1 << 64) - 1
+    encoded = bytearray()
+    while number > 0x7f:
+        encoded.append((number & 0x7f) | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def encodeTag(field_number, wire_type):
+    return encodeVarint((field_number << 3) | wire_type)
+
+
+def encodeVarintField(field_number, number):
+    # Like proto3, the default value (0) is not serialized
+    if number == 0:
+        return b''
+    return encodeTag(field_number, VARINT) + encodeVarint(number)
+
+
+def encodeLenField(field_number, payload):
+    return encodeTag(field_number, LEN) + encodeVarint(len(payload)) + payload
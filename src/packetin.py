@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import struct
+from pypacker.layer12 import ethernet
+
+from .constants import *
+
+ETHERTYPE_IPV4 = 0x0800
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+# Header layouts of switch.p4, which parses the IPv4 header without options
+ETHERNET_LENGTH = 14
+IPV4_LENGTH = 20
+VERIFICATION_LENGTH = 3
+
+ETHERTYPE = struct.Struct('!12xH')
+IPV4 = struct.Struct('!9xB2xII') # protocol, srcAddr, dstAddr
+VERIFICATION = struct.Struct('!BH') # protocol, dfaState
+L4_PORTS = struct.Struct('!HH') # srcPort, dstPort (both TCP and UDP)
+
+IPV4_OFFSET = ETHERNET_LENGTH
+L4_OFFSET = IPV4_OFFSET + IPV4_LENGTH
+
+
+class PacketInHeaders:
+    """
+    Header fields of a packet-in payload that the controller needs, read at the
+    fixed offsets of the switch.p4 headers without copying the payload. The
+    fields of the headers that the packet does not carry are 0 (dfa_state is
+    None without a verification header). The full pypacker parsing of the frame
+    is only done by ethernet().
+    """
+
+    __slots__ = ('payload', 'eth_type', 'src_ip', 'dst_ip', 'proto',
+                 'dfa_state', 'src_port', 'dst_port')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.eth_type = 0
+        self.src_ip = self.dst_ip = self.proto = 0
+        self.dfa_state = None
+        self.src_port = self.dst_port = 0
+
+        view = memoryview(payload)
+        length = len(view)
+        if length < ETHERNET_LENGTH:
+            return
+        self.eth_type = ETHERTYPE.unpack_from(view)[0]
+        if (self.eth_type != ETHERTYPE_IPV4 or
+                length < IPV4_OFFSET + IPV4_LENGTH):
+            return
+        self.proto, self.src_ip, self.dst_ip = IPV4.unpack_from(
+            view, IPV4_OFFSET)
+
+        offset = L4_OFFSET
+        if self.proto == PROTO_VERIFICATION:
+            if length < offset + VERIFICATION_LENGTH:
+                return
+            # The original protocol is kept in the verification header
+            self.proto, self.dfa_state = VERIFICATION.unpack_from(view, offset)
+            offset += VERIFICATION_LENGTH
+        if (self.proto in (IP_PROTO_TCP, IP_PROTO_UDP) and
+                length >= offset + L4_PORTS.size):
+            self.src_port, self.dst_port = L4_PORTS.unpack_from(view, offset)
+
+    @property
+    def flow(self):
+        return (self.src_ip, self.dst_ip, self.proto, self.src_port,
+                self.dst_port)
+
+    def ethernet(self):
+        "Returns the frame fully parsed by pypacker"
+        return ethernet.Ethernet(bytes(self.payload))
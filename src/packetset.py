@@ -2,140 +2,363 @@
 
 import ipaddress
 
+IPV4_WIDTH = 32
+PROTO_WIDTH = 8
+PORT_WIDTH = 16
+
+
+def range_to_prefixes(low, high, width=IPV4_WIDTH):
+    """
+    Minimal list of disjoint prefixes (value, prefix length) that covers
+    exactly the range [low, high] of width-bit integers: at most 2 * width - 2
+    """
+    prefixes = []
+    while low <= high:
+        # Largest aligned block that starts at low and fits in the range
+        size = low & -low if low > 0 else 1 << width
+        while size > high - low + 1:
+            size >>= 1
+        prefixes.append((low, width + 1 - size.bit_length()))
+        low += size
+    return prefixes
+
+
+def prefix_mask(prefix_len, width=IPV4_WIDTH):
+    "Ternary mask of a prefix"
+    return ((1 << prefix_len) - 1) << (width - prefix_len)
+
+
+# Fields of the boxes, in order, and their widths
+FIELDS = ('src_ip', 'dst_ip', 'proto', 'src_port', 'dst_port')
+WIDTHS = (IPV4_WIDTH, IPV4_WIDTH, PROTO_WIDTH, PORT_WIDTH, PORT_WIDTH)
+IP_FIELDS = ('src_ip', 'dst_ip')
+FULL_RANGES = tuple((0, (1 << width) - 1) for width in WIDTHS)
+
+
+def _parse_value(field, width, value):
+    # Value of a field (integer, or IPv4 string for the IP fields) -> integer
+    if isinstance(value, str) and field in IP_FIELDS:
+        return int(ipaddress.IPv4Address(value))
+    if not isinstance(value, int) or not 0 <= value < (1 << width):
+        raise Exception('Invalid {} value {}'.format(field, value))
+    return value
+
+
+def _box_intersection(a, b):
+    box = []
+    for (a_low, a_high), (b_low, b_high) in zip(a, b):
+        low = max(a_low, b_low)
+        high = min(a_high, b_high)
+        if low > high:
+            return None
+        box.append((low, high))
+    return tuple(box)
+
+
+def _box_difference(a, b):
+    # Disjoint boxes that cover a - b: at most two per dimension
+    inter = _box_intersection(a, b)
+    if inter == None:
+        return [a]
+    boxes = []
+    for dim, ((low, high), (i_low, i_high)) in enumerate(zip(a, inter)):
+        # Boxes of a below and above the intersection in this dimension, within
+        # the intersection in the dimensions before
+        head = inter[:dim]
+        tail = a[dim + 1:]
+        if low < i_low:
+            boxes.append(head + ((low, i_low - 1),) + tail)
+        if i_high < high:
+            boxes.append(head + ((i_high + 1, high),) + tail)
+    return boxes
+
+
+def _normalize(boxes):
+    """
+    Canonical disjoint boxes of the union of the boxes: the first dimension is
+    split into the maximal ranges over which the cross section of the union is
+    the same, and each cross section is normalized in the same way over the
+    next dimensions. Equal unions thus have equal boxes.
+    """
+    boxes = list(boxes)
+    if len(boxes) == 0:
+        return ()
+    num_dims = len(boxes[0])
+    dim_events = [] # per dimension, sorted (point, bitmask of boxes)
+    for dim in range(num_dims):
+        events = dict()
+        for j, box in enumerate(boxes):
+            low, high = box[dim]
+            events[low] = events.get(low, 0) ^ (1 << j)
+            events[high + 1] = events.get(high + 1, 0) ^ (1 << j)
+        dim_events.append(sorted(events.items()))
+    memo = dict() # (dimension, bitmask of boxes) -> normalized boxes
+
+    def sweep(dim, active):
+        key = (dim, active)
+        result = memo.get(key)
+        if result != None:
+            return result
+        slabs = [] # [ low, high, cross section ]
+        covering = 0
+        low = None
+        for point, toggled in dim_events[dim]:
+            toggled &= active
+            if toggled == 0:
+                continue
+            if covering != 0:
+                section = ((),)
+                if dim + 1 < num_dims:
+                    section = sweep(dim + 1, covering)
+                if (len(slabs) > 0 and slabs[-1][1] == low - 1 and
+                        slabs[-1][2] == section):
+                    slabs[-1][1] = point - 1
+                else:
+                    slabs.append([low, point - 1, section])
+            covering ^= toggled
+            low = point
+        result = tuple(((low, high),) + sub_box
+                       for low, high, section in slabs
+                       for sub_box in section)
+        memo[key] = result
+        return result
+
+    return sweep(0, (1 << len(boxes)) - 1)
+
 
 class PacketSet:
     """
-    For now, a PacketSet object describes a set of packets with continuous
-    ranges of header fields. However, we may want to optimize by aggregating the
-    ranges to reduce the number of rules needed to be installed in future.
+    Set of packets with continuous ranges of header fields, i.e., a box. The
+    ranges are kept as (low, high) integers, in the order of FIELDS, and the
+    empty set has no ranges. The unions and differences of boxes are generally
+    not boxes; they are returned as PacketSetUnion objects.
+
+    A PacketSet is built from a spec, as in the invariants, that maps the
+    fields to their [low, high] ranges, or to single values. The IP fields take
+    IPv4 strings or integers, the others integers. The fields missing from the
+    spec have the full range, and as they do not constrain the packets, they
+    add no match fields to the rules (see constrained) and no breakpoints to
+    the PECs.
     """
 
-    def __init__(self):
-        self._src_ip = None
-        self._dst_ip = None
+    __slots__ = ('_box',)
 
-    def __init__(self, spec):
-        self._src_ip = (ipaddress.ip_address('0.0.0.0'),
-                        ipaddress.ip_address('255.255.255.255'))
-        self._dst_ip = (ipaddress.ip_address('0.0.0.0'),
-                        ipaddress.ip_address('255.255.255.255'))
+    def __init__(self, spec=None):
+        spec = spec or {}
+        box = []
+        for field, width, full_range in zip(FIELDS, WIDTHS, FULL_RANGES):
+            value = spec.get(field, full_range)
+            if not isinstance(value, (list, tuple)):
+                value = (value, value)
+            low = _parse_value(field, width, value[0])
+            high = _parse_value(field, width, value[1])
+            box.append((low, high))
+        self._box = tuple(box)
+        if any(low > high for low, high in self._box):
+            self._box = None
 
-        if 'src_ip' in spec:
-            self._src_ip = (ipaddress.ip_address(spec['src_ip'][0]),
-                            ipaddress.ip_address(spec['src_ip'][1]))
-        if 'dst_ip' in spec:
-            self._dst_ip = (ipaddress.ip_address(spec['dst_ip'][0]),
-                            ipaddress.ip_address(spec['dst_ip'][1]))
+    @classmethod
+    def from_box(cls, box):
+        "PacketSet of a box of integer ranges (in the order of FIELDS)"
+        packet_set = cls.__new__(cls)
+        packet_set._box = tuple(box) if box != None else None
+        return packet_set
 
-    def __init__(self, src_ip_lb, src_ip_ub, dst_ip_lb, dst_ip_ub):
-        self._src_ip = (src_ip_lb, src_ip_ub)
-        self._dst_ip = (dst_ip_lb, dst_ip_ub)
+    @classmethod
+    def empty(cls):
+        return cls.from_box(None)
+
+    def box(self):
+        return self._box
 
     def __str__(self):
-        return ('src_ip: ' + str(self._src_ip) + ', '
-                'dst_ip: ' + str(self._dst_ip))
+        desc = ('src_ip: ' + str(self.src_ip()) + ', '
+                'dst_ip: ' + str(self.dst_ip()))
+        for field, value in self.constrained():
+            if field not in IP_FIELDS:
+                desc += ', ' + field + ': ' + str(value)
+        return desc
+
+    def __repr__(self):
+        return 'PacketSet(' + str(self) + ')'
 
     def __eq__(self, other):
-        return (self._src_ip == other._src_ip and self._dst_ip == other._dst_ip)
+        return isinstance(other, PacketSet) and self._box == other._box
+
+    def __hash__(self):
+        return hash(self._box)
 
     def __add__(self, other):
-        self.union(other)
+        return self.union(other)
 
     def __sub__(self, other):
-        self.difference(other)
+        return self.difference(other)
 
     def __and__(self, other):
-        self.intersection(other)
+        return self.intersection(other)
 
     def __or__(self, other):
-        self.union(other)
+        return self.union(other)
 
-    def src_ip(self):
-        if self._src_ip == None:
+    def _ip_range(self, dim):
+        if self._box == None:
             return None
-        return (str(self._src_ip[0]), str(self._src_ip[1]))
+        return tuple(
+            str(ipaddress.IPv4Address(value)) for value in self._box[dim])
+
+    def src_ip(self):
+        return self._ip_range(0)
 
     def dst_ip(self):
-        if self._dst_ip == None:
+        return self._ip_range(1)
+
+    def range(self, field):
+        "(low, high) integers of a field"
+        if self._box == None:
             return None
-        return (str(self._dst_ip[0]), str(self._dst_ip[1]))
+        return self._box[FIELDS.index(field)]
+
+    def constrained(self):
+        "(field, (low, high)) of the fields whose ranges are not full"
+        if self._box == None:
+            return []
+        return [
+            (field, value)
+            for field, value, full_range in zip(FIELDS, self._box, FULL_RANGES)
+            if value != full_range
+        ]
 
     def is_all(self):
-        return (self._src_ip == (ipaddress.ip_address('0.0.0.0'),
-                                 ipaddress.ip_address('255.255.255.255')) and
-                self._dst_ip == (ipaddress.ip_address('0.0.0.0'),
-                                 ipaddress.ip_address('255.255.255.255')))
+        return self._box == FULL_RANGES
 
     def is_empty(self):
-        assert ((self._src_ip == None and self._dst_ip == None) or
-                (self._src_ip != None and self._dst_ip != None))
-        return (self._src_ip != None and self._dst_ip != None)
+        return self._box == None
 
     def contains(self, other):
+        if isinstance(other, PacketSetUnion):
+            return all(self.contains(ps) for ps in other)
         if other.is_empty():
             return True
         if self.is_empty():
             return False
-
-        return (self._src_ip[0] <= other._src_ip[0] and
-                other._src_ip[1] <= self._src_ip[1] and
-                self._dst_ip[0] <= other._dst_ip[0] and
-                other._dst_ip[1] <= self._dst_ip[1])
+        ranges = zip(self._box, other._box)
+        return all(low <= o_low and o_high <= high
+                   for (low, high), (o_low, o_high) in ranges)
 
     def overlaps(self, other):
+        if isinstance(other, PacketSetUnion):
+            return other.overlaps(self)
         if self.is_empty() or other.is_empty():
             return False
-
-        return (max(self._src_ip[0], other._src_ip[0]) <= min(
-            self._src_ip[1], other._src_ip[1]) and
-                max(self._dst_ip[0], other._dst_ip[0]) <= min(
-                    self._dst_ip[1], other._dst_ip[1]))
+        return _box_intersection(self._box, other._box) != None
 
     def union(self, other):
-        # The current data structure (ranges of fields) cannot represent the
-        # union sets correctly, given the assumption that a packet set should be
-        # anywhere continuous within the field ranges, unless we return a list
-        # of packet sets. In the future, we may want to look into other PEC
-        # related libraries/implementation.
-        raise Exception('Unsupported operation')
+        return PacketSetUnion([self]).union(other)
 
     def difference(self, other):
-        intersection_set = self.intersection(other)
-        if intersection_set.is_empty():
-            return [self]
-
-        # TODO
-        src_ip_ranges = []
-        if self._src_ip[0] < intersection_set._src_ip[0]:
-            src_ip_ranges.append(
-                (self._src_ip[0], intersection_set._src_ip[0] - 1))
-        src_ip_ranges.append(intersection_set._src_ip)
-        if intersection_set._src_ip[1] < self._src_ip[1]:
-            src_ip_ranges.append(
-                (intersection_set._src_ip[1] + 1, self._src_ip[1]))
-
-        dst_ip_ranges = []
-        if self._dst_ip[0] < intersection_set._dst_ip[0]:
-            dst_ip_ranges.append(
-                (self._dst_ip[0], intersection_set._dst_ip[0] - 1))
-        dst_ip_ranges.append(intersection_set._dst_ip)
-        if intersection_set._dst_ip[1] < self._dst_ip[1]:
-            dst_ip_ranges.append(
-                (intersection_set._dst_ip[1] + 1, self._dst_ip[1]))
-
-        return []
+        return PacketSetUnion([self]).difference(other)
 
     def intersection(self, other):
+        if isinstance(other, PacketSetUnion):
+            return other.intersection(self)
         if self.is_empty() or other.is_empty():
-            return PacketSet()
-
-        src_ip_glb = max(self._src_ip[0], other._src_ip[0])
-        src_ip_lub = min(self._src_ip[1], other._src_ip[1])
-        dst_ip_glb = max(self._dst_ip[0], other._dst_ip[0])
-        dst_ip_lub = min(self._dst_ip[1], other._dst_ip[1])
-
-        if src_ip_glb <= src_ip_lub and dst_ip_glb <= dst_ip_lub:
-            # There is an overlap. Intersection set is not null
-            return PacketSet(src_ip_glb, src_ip_lub, dst_ip_glb, dst_ip_lub)
-        else:
-            return PacketSet()
+            return PacketSet.empty()
+        return PacketSet.from_box(_box_intersection(self._box, other._box))
+
+
+class PacketSetUnion:
+    """
+    Union of packet sets, kept as the disjoint boxes of a canonical
+    decomposition (see _normalize), so that equal unions compare and hash
+    equal. Iterating over a PacketSetUnion yields its boxes as PacketSets.
+    """
+
+    __slots__ = ('_boxes',)
+
+    def __init__(self, packet_sets=()):
+        boxes = []
+        for packet_set in packet_sets:
+            boxes.extend(_boxes_of(packet_set))
+        self._boxes = _normalize(boxes)
+
+    @classmethod
+    def _from_normalized(cls, boxes):
+        union = cls.__new__(cls)
+        union._boxes = boxes
+        return union
+
+    def boxes(self):
+        return self._boxes
+
+    def __iter__(self):
+        return (PacketSet.from_box(box) for box in self._boxes)
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __str__(self):
+        return ' | '.join('(' + str(ps) + ')' for ps in self) or 'empty'
+
+    def __repr__(self):
+        return 'PacketSetUnion(' + str(self) + ')'
+
+    def __eq__(self, other):
+        return isinstance(other, PacketSetUnion) and self._boxes == other._boxes
+
+    def __hash__(self):
+        return hash(self._boxes)
+
+    def __add__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def is_empty(self):
+        return len(self._boxes) == 0
+
+    def contains(self, other):
+        return other.difference(self).is_empty()
+
+    def overlaps(self, other):
+        return any(
+            _box_intersection(box, other_box) != None
+            for box in self._boxes
+            for other_box in _boxes_of(other))
+
+    def union(self, other):
+        return PacketSetUnion._from_normalized(
+            _normalize(self._boxes + tuple(_boxes_of(other))))
+
+    def difference(self, other):
+        boxes = list(self._boxes)
+        for other_box in _boxes_of(other):
+            boxes = [
+                piece for box in boxes
+                for piece in _box_difference(box, other_box)
+            ]
+        return PacketSetUnion._from_normalized(_normalize(boxes))
+
+    def intersection(self, other):
+        # The boxes of both sides are disjoint, and so are their intersections
+        boxes = []
+        for box in self._boxes:
+            for other_box in _boxes_of(other):
+                inter = _box_intersection(box, other_box)
+                if inter != None:
+                    boxes.append(inter)
+        return PacketSetUnion._from_normalized(_normalize(boxes))
+
+
+def _boxes_of(packet_set):
+    if isinstance(packet_set, PacketSetUnion):
+        return packet_set.boxes()
+    if packet_set.is_empty():
+        return ()
+    return (packet_set.box(),)
@@ -3,10 +3,20 @@ Functions -
 ranges_to_points(dim_ranges): given ranges for a single dimension, returns the list of points that must be tested for PECs.
 identify_pec(ranges, point): given ranges for all dimensions and a specific point, returns the tuple that represents the PEC the point belongs to.
 pec_calc(ranges): given ranges for all dimensions, return labels for distinct PECs.
+pec_sweep(ranges), pec_regions(ranges): same PECs as pec_calc (with their regions), by sweeping each dimension.
+ranges_to_array(ranges), membership_bitmaps(range_array, points), pec_vectorized(ranges): numpy versions of identify_pec and pec_calc.
 
 '''
 
 import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bound (in bytes) of the intermediate arrays of the numpy functions
+CHUNK_BYTES = 1 << 24
 '''
 params------------
 dim_ranges : list of tuples, where each tuple represents a range in a specific domain. ex) [(10,20), (15,25)] if we have two invariants,
@@ -80,6 +90,272 @@ def pec_calc(ranges):
     return pecs
 
 
+'''
+params------------
+ranges: same as ranges for identify_pec.
+
+ret---------------
+pecs : same as pec_calc, computed by sweeping each dimension in turn (see
+        pec_regions) instead of classifying every point of the product of the
+        breakpoints.
+'''
+
+
+def pec_sweep(ranges):
+    return set(
+        _mask_to_pec(mask)
+        for mask in _sweep_masks(_dim_events(ranges), 0, (1 << len(ranges)) -
+                                 1, dict()))
+
+
+'''
+params------------
+ranges: same as ranges for identify_pec.
+
+ret---------------
+regions : dict of the PECs (as returned by pec_calc) to their regions, as lists
+        of disjoint boxes. Each box is a tuple of (low, high) ranges, one per
+        dimension. ex) {(0,): [((10,14),(10,20))], (0,1): [((15,20),(15,20))]}
+
+The first dimension is swept over the breakpoints of the ranges; for each slab
+between two breakpoints, the invariants whose ranges cover the slab (as a
+bitmask) are swept over the next dimension, and so on. Only the non-empty
+overlaps are visited, and the sweeps of a dimension are memoized by the set of
+invariants, since many slabs share it. Boxes of the same PEC in adjacent slabs
+are merged.
+'''
+
+
+def pec_regions(ranges):
+    regions = dict()
+    for mask, box in _sweep_boxes(_dim_events(ranges), 0,
+                                  (1 << len(ranges)) - 1, dict()):
+        regions.setdefault(_mask_to_pec(mask), []).append(box)
+    return regions
+
+
+def _dim_events(ranges):
+    # Per dimension, the sorted breakpoints of the ranges: (point, bitmask of
+    # the invariants whose ranges start or end there)
+    dim_events = []
+    for dim in range(len(ranges[0])):
+        events = dict()
+        for j, r in enumerate(ranges):
+            events[r[dim][0]] = events.get(r[dim][0], 0) ^ (1 << j)
+            events[r[dim][1] + 1] = events.get(r[dim][1] + 1, 0) ^ (1 << j)
+        dim_events.append(sorted(events.items()))
+    return dim_events
+
+
+def _slabs(events, active):
+    # Yields the (low, high, bitmask) slabs covered by the active invariants
+    covering = 0
+    low = None
+    for point, toggled in events:
+        toggled &= active
+        if toggled == 0:
+            continue
+        if covering != 0:
+            yield low, point - 1, covering
+        covering ^= toggled
+        low = point
+
+
+def _sweep_masks(dim_events, dim, active, memo):
+    key = (dim, active)
+    masks = memo.get(key)
+    if masks == None:
+        masks = set()
+        for _, _, covering in _slabs(dim_events[dim], active):
+            if dim == len(dim_events) - 1:
+                masks.add(covering)
+            else:
+                masks |= _sweep_masks(dim_events, dim + 1, covering, memo)
+        memo[key] = masks
+    return masks
+
+
+def _sweep_boxes(dim_events, dim, active, memo):
+    key = (dim, active)
+    boxes = memo.get(key)
+    if boxes != None:
+        return boxes
+    boxes = []
+    if dim == len(dim_events) - 1:
+        for low, high, covering in _slabs(dim_events[dim], active):
+            boxes.append((covering, ((low, high),)))
+        memo[key] = boxes
+        return boxes
+
+    # Boxes open in the previous slab: (bitmask, box of the next dimensions)
+    # -> low point in this dimension
+    open_boxes = dict()
+    prev_high = None
+    for low, high, covering in _slabs(dim_events[dim], active):
+        sub_boxes = _sweep_boxes(dim_events, dim + 1, covering, memo)
+        if prev_high != low - 1:
+            for (mask, sub_box), box_low in open_boxes.items():
+                boxes.append((mask, ((box_low, prev_high),) + sub_box))
+            open_boxes = dict()
+        next_open = dict()
+        for sub in sub_boxes:
+            next_open[sub] = open_boxes.pop(sub, low)
+        for (mask, sub_box), box_low in open_boxes.items():
+            boxes.append((mask, ((box_low, prev_high),) + sub_box))
+        open_boxes = next_open
+        prev_high = high
+    for (mask, sub_box), box_low in open_boxes.items():
+        boxes.append((mask, ((box_low, prev_high),) + sub_box))
+    memo[key] = boxes
+    return boxes
+
+
+def _mask_to_pec(mask):
+    pec = []
+    j = 0
+    while mask:
+        if mask & 1:
+            pec.append(j)
+        mask >>= 1
+        j += 1
+    return tuple(pec)
+
+
+def _require_numpy():
+    if np == None:
+        raise Exception('numpy is required for the vectorized PEC functions')
+
+
+'''
+params------------
+ranges: same as ranges for identify_pec.
+
+ret---------------
+range_array : (N, D, 2) integer array of the ranges of the N invariants over the
+        D dimensions; range_array[j, i] is the (low, high) of invariant j for
+        dimension i.
+'''
+
+
+def ranges_to_array(ranges):
+    _require_numpy()
+    return np.asarray(ranges, dtype=np.int64).reshape(len(ranges), -1, 2)
+
+
+'''
+params------------
+range_array : as returned by ranges_to_array.
+points : (P, D) integer array of points. ex) [(12, 13), (16, 16)] for 2d
+
+ret---------------
+bitmaps : (P, ceil(N / 8)) uint8 array, where each row is the membership bitmap
+        of a point (np.packbits of the invariants whose ranges contain it, in
+        big-endian bit order). This is identify_pec for a whole batch of
+        points: the points are compared with the ranges of all invariants at
+        once by broadcasting, a chunk of points at a time.
+'''
+
+
+def membership_bitmaps(range_array, points):
+    _require_numpy()
+    points = np.asarray(points, dtype=np.int64)
+    lows = range_array[np.newaxis, :, :, 0]
+    highs = range_array[np.newaxis, :, :, 1]
+    num_invariants, num_dims = range_array.shape[:2]
+    chunk = max(1, CHUNK_BYTES // max(1, num_invariants * num_dims))
+    bitmaps = []
+    for start in range(0, len(points), chunk):
+        p = points[start:start + chunk, np.newaxis, :]
+        inside = ((p >= lows) & (p <= highs)).all(axis=2)
+        bitmaps.append(np.packbits(inside, axis=1))
+    if len(bitmaps) == 0:
+        return np.zeros((0, (num_invariants + 7) // 8), dtype=np.uint8)
+    return np.concatenate(bitmaps)
+
+
+'''
+params------------
+bitmaps : (P, B) uint8 array of membership bitmaps (see membership_bitmaps).
+
+ret---------------
+classes : (C, B) array of the distinct bitmaps, i.e., PECs.
+inverse : (P,) array of the index in classes of the bitmap of each point.
+'''
+
+
+def distinct_bitmaps(bitmaps):
+    _require_numpy()
+    bitmaps = np.ascontiguousarray(bitmaps, dtype=np.uint8)
+    if bitmaps.shape[1] == 0:
+        return bitmaps[:1], np.zeros(len(bitmaps), dtype=np.intp)
+    # Each row is compared as a single opaque value of B bytes
+    rows = bitmaps.view(np.dtype((np.void, bitmaps.shape[1]))).ravel()
+    classes, inverse = np.unique(rows, return_inverse=True)
+    return classes.view(np.uint8).reshape(-1, bitmaps.shape[1]), inverse
+
+
+'''
+params------------
+bitmap : a row of membership_bitmaps.
+num_invariants : N.
+
+ret---------------
+tuple(ret): the PEC of the bitmap, as returned by identify_pec.
+'''
+
+
+def bitmap_to_pec(bitmap, num_invariants):
+    _require_numpy()
+    bits = np.unpackbits(bitmap, count=num_invariants)
+    return tuple(int(j) for j in np.flatnonzero(bits))
+
+
+'''
+params------------
+ranges: same as ranges for identify_pec.
+
+ret---------------
+pecs : same as pec_calc, with numpy.
+
+Instead of classifying every point of the product of the breakpoints, the
+breakpoints of each dimension are classified on their own (membership_bitmaps
+of that dimension), and the distinct bitmaps of a dimension are ANDed with the
+distinct bitmaps of the dimensions before it, by broadcasting. Only the
+distinct non-empty bitmaps are kept after each dimension, so the work grows
+with the number of PECs rather than with the number of points.
+'''
+
+
+def pec_vectorized(ranges):
+    range_array = ranges_to_array(ranges)
+    num_invariants, num_dims = range_array.shape[:2]
+    classes = None
+    for dim in range(num_dims):
+        dim_array = range_array[:, dim:dim + 1, :]
+        points = ranges_to_points(range_array[:, dim, :].tolist())
+        dim_classes = _nonempty(
+            distinct_bitmaps(
+                membership_bitmaps(dim_array,
+                                   np.asarray(points).reshape(-1, 1)))[0])
+        if classes is None:
+            classes = dim_classes
+            continue
+        chunk = max(1, CHUNK_BYTES // max(1, dim_classes.size))
+        combined = [classes[:0]]
+        for start in range(0, len(classes), chunk):
+            anded = (classes[start:start + chunk, np.newaxis, :] &
+                     dim_classes[np.newaxis, :, :])
+            combined.append(
+                _nonempty(
+                    distinct_bitmaps(anded.reshape(-1, classes.shape[1]))[0]))
+        classes = _nonempty(distinct_bitmaps(np.concatenate(combined))[0])
+    return set(bitmap_to_pec(bitmap, num_invariants) for bitmap in classes)
+
+
+def _nonempty(bitmaps):
+    return bitmaps[bitmaps.any(axis=1)]
+
+
 '''
 
 PEC=identify_PEC([[(10,20),(10,20)],[(15,25),(15,25)]], (11,11))
@@ -91,9 +367,11 @@ print(points)
 
 #ret=pec_calc([[(10,20),(10,20),(10,20)],[(15,25),(15,25),(15,25)],[(11,23),(17,30),(10,30)]])
 '''
-ret = pec_calc([[(10, 20), (10, 20), (10, 20)], [(10, 20), (10, 20), (10, 20)],
-                [(10, 20), (10, 20), (10, 20)]])
-print(ret)
+if __name__ == '__main__':
+    ret = pec_calc([[(10, 20), (10, 20), (10, 20)],
+                    [(10, 20), (10, 20), (10, 20)],
+                    [(10, 20), (10, 20), (10, 20)]])
+    print(ret)
 '''
 #This function is not used.
 
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+from p4.v1 import p4runtime_pb2
+from p4.config.v1 import p4info_pb2
+
+MatchField = p4info_pb2.MatchField
+
+
+class RuleKeys:
+    """
+    Canonical forms of the rules (dicts of table_name, match_fields,
+    action_name, action_params and priority) and of the table entries read
+    from the switches, so that they can be compared regardless of how the
+    values are written (e.g., IPv4 strings or integers, widths of the byte
+    strings, don't care fields).
+
+    The key of a rule identifies its table entry: the table, the priority and
+    the values of the match fields. The action is the action and the values of
+    its params.
+    """
+
+    def __init__(self, p4info_helper):
+        self.p4info_helper = p4info_helper
+        self.match_fields = dict() # (table name, field name) -> field info
+        self.action_params = dict() # (action name, param name) -> param info
+
+    def _match_field(self, table_name, name):
+        info = self.match_fields.get((table_name, name))
+        if info == None:
+            helper = self.p4info_helper
+            mf = helper.get_match_field(table_name, name)
+            info = (mf.id, mf.match_type, mf.bitwidth,
+                    helper.match_field_encoders[(table_name, name)])
+            self.match_fields[(table_name, name)] = info
+        return info
+
+    def _action_param(self, action_name, name):
+        info = self.action_params.get((action_name, name))
+        if info == None:
+            helper = self.p4info_helper
+            param = helper.get_action_param(action_name, name)
+            info = (param.id, helper.action_param_encoders[(action_name, name)])
+            self.action_params[(action_name, name)] = info
+        return info
+
+    @staticmethod
+    def _canonical_match(match_type, bitwidth, values):
+        # Returns None for the don't care matches, which are omitted
+        if match_type == MatchField.LPM:
+            if values[1] == 0:
+                return None
+        elif match_type == MatchField.TERNARY:
+            if values[1] == 0:
+                return None
+            values = (values[0] & values[1], values[1])
+        elif match_type == MatchField.RANGE:
+            if values[0] == 0 and values[1] == (1 << bitwidth) - 1:
+                return None
+        return values
+
+    def rule_key(self, rule):
+        table_name = rule['table_name']
+        matches = []
+        for name, value in rule.get('match_fields', {}).items():
+            field_id, match_type, bitwidth, encode = self._match_field(
+                table_name, name)
+            decode = lambda x: int.from_bytes(encode(x), byteorder='big')
+            if match_type in (MatchField.EXACT, MatchField.OPTIONAL):
+                values = (decode(value),)
+            elif match_type == MatchField.LPM:
+                values = (decode(value[0]), value[1])
+            else:
+                values = (decode(value[0]), decode(value[1]))
+            values = self._canonical_match(match_type, bitwidth, values)
+            if values != None:
+                matches.append((field_id, values))
+        return (self.p4info_helper.get_tables_id(table_name),
+                rule.get('priority', 0), tuple(sorted(matches)))
+
+    def entry_key(self, table_entry):
+        table_name = self.p4info_helper.get_tables_name(table_entry.table_id)
+        matches = []
+        for m in table_entry.match:
+            mf = self.p4info_helper.get_match_field(table_name, id=m.field_id)
+            decode = lambda x: int.from_bytes(x, byteorder='big')
+            which = m.WhichOneof('field_match_type')
+            if which == 'exact':
+                values = (decode(m.exact.value),)
+            elif which == 'optional':
+                values = (decode(m.optional.value),)
+            elif which == 'lpm':
+                values = (decode(m.lpm.value), m.lpm.prefix_len)
+            elif which == 'ternary':
+                values = (decode(m.ternary.value), decode(m.ternary.mask))
+            elif which == 'range':
+                values = (decode(m.range.low), decode(m.range.high))
+            else:
+                raise Exception('Unsupported match type {}'.format(which))
+            values = self._canonical_match(mf.match_type, mf.bitwidth, values)
+            if values != None:
+                matches.append((m.field_id, values))
+        return (table_entry.table_id, table_entry.priority,
+                tuple(sorted(matches)))
+
+    def rule_action(self, rule):
+        action_name = rule.get('action_name')
+        if action_name == None:
+            return None
+        params = []
+        for name, value in rule.get('action_params', {}).items():
+            param_id, encode = self._action_param(action_name, name)
+            params.append(
+                (param_id, int.from_bytes(encode(value), byteorder='big')))
+        return (self.p4info_helper.get_actions_id(action_name),
+                tuple(sorted(params)))
+
+    def entry_action(self, table_entry):
+        if table_entry.action.WhichOneof('type') != 'action':
+            return None
+        action = table_entry.action.action
+        params = [(p.param_id, int.from_bytes(p.value, byteorder='big'))
+                  for p in action.params]
+        return (action.action_id, tuple(sorted(params)))
+
+
+def diff_rules(rule_keys, rules, table_entries):
+    """
+    Returns the updates that turn the table entries of a switch into the given
+    rules, as lists of:
+        inserts: rules missing on the switch
+        modifies: rules whose entries have another action on the switch
+        deletes: table entries (p4runtime_pb2.TableEntry) without rules
+    The entries with the default action are left as they are.
+    """
+    desired = dict()
+    for rule in rules:
+        desired.setdefault(rule_keys.rule_key(rule), rule)
+
+    inserts = []
+    modifies = []
+    deletes = []
+    current = set()
+    for entry in table_entries:
+        if entry.is_default_action:
+            continue
+        key = rule_keys.entry_key(entry)
+        current.add(key)
+        rule = desired.get(key)
+        if rule == None:
+            deletes.append(entry)
+        elif rule_keys.rule_action(rule) != rule_keys.entry_action(entry):
+            modifies.append(rule)
+    for key, rule in desired.items():
+        if key not in current:
+            inserts.append(rule)
+    return inserts, modifies, deletes
@@ -4,6 +4,14 @@ from collections import defaultdict
 import re
 
 
+def positions(mask):
+    # Iterate over the positions (set bits) of a position bitmask
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
 class Node:
 
     def __init__(self, val, pos, left=None, right=None):
@@ -53,82 +61,90 @@ class AST:
                 raise Exception('Invalid token: ' + token)
         self.root = stack[0]
 
-    @staticmethod
-    def _get_positions(node, firstPositions, lastPositions, followPositions):
-        if node == None:
-            return
-
-        # Post-order traversal for bottom-up construction
-        AST._get_positions(node.left, firstPositions, lastPositions,
-                           followPositions)
-        AST._get_positions(node.right, firstPositions, lastPositions,
-                           followPositions)
-
-        # First positions
-        if node.is_leaf() and node.pos > 0:
-            firstPositions[node] = set([node.pos])
-        elif node.val == Regex.OP_UNION:
-            firstPositions[node] = (firstPositions[node.left] |
-                                    firstPositions[node.right])
-        elif node.val == Regex.OP_CONCAT:
-            if node.left.nullable():
-                firstPositions[node] = (firstPositions[node.left] |
-                                        firstPositions[node.right])
-            else:
-                firstPositions[node] = firstPositions[node.left]
-        elif node.val == Regex.OP_KLEENE:
-            firstPositions[node] = firstPositions[node.left]
-        else:
-            firstPositions[node] = set()
-
-        # Last positions
-        if node.is_leaf() and node.pos > 0:
-            lastPositions[node] = set([node.pos])
-        elif node.val == Regex.OP_UNION:
-            lastPositions[node] = (lastPositions[node.left] |
-                                   lastPositions[node.right])
-        elif node.val == Regex.OP_CONCAT:
-            if node.right.nullable():
-                lastPositions[node] = (lastPositions[node.left] |
-                                       lastPositions[node.right])
-            else:
-                lastPositions[node] = lastPositions[node.right]
-        elif node.val == Regex.OP_KLEENE:
-            lastPositions[node] = lastPositions[node.left]
-        else:
-            lastPositions[node] = set()
-
-        # Follow positions
-        if node.val == Regex.OP_CONCAT:
-            for i in lastPositions[node.left]:
-                followPositions[i] |= firstPositions[node.right]
-        elif node.val == Regex.OP_KLEENE:
-            for i in lastPositions[node]:
-                followPositions[i] |= firstPositions[node]
+    def _postorder(self):
+        # Iterative traversal (children before parents), as union chains of
+        # large alphabets are too deep for recursion
+        nodes = list()
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            if node.left != None:
+                stack.append(node.left)
+            if node.right != None:
+                stack.append(node.right)
+        return reversed(nodes)
 
     def getPositions(self):
+        # Position sets are bitmasks, where bit i is set iff position i is in
+        # the set, so that unions and intersections are single int operations.
         firstpos = dict()
         lastpos = dict()
-        followpos = defaultdict(set)
-        AST._get_positions(self.root, firstpos, lastpos, followpos)
-        return (firstpos, lastpos, followpos)
-
-    @staticmethod
-    def _getTokenPosMap(node, tokenPosMap):
-        if node == None:
-            return
+        followpos = defaultdict(int)
+        nullable = dict()
+
+        # Bottom-up construction
+        for node in self._postorder():
+            if node.is_leaf() and node.val == Regex.OP_END:
+                nullable[node] = True
+            elif node.is_leaf() and node.pos > 0:
+                nullable[node] = False
+            elif node.val == Regex.OP_UNION:
+                nullable[node] = nullable[node.left] or nullable[node.right]
+            elif node.val == Regex.OP_CONCAT:
+                nullable[node] = nullable[node.left] and nullable[node.right]
+            elif node.val == Regex.OP_KLEENE:
+                nullable[node] = True
+            else:
+                raise Exception('Unrecognizable node ' + str(node))
+
+            # First and last positions
+            if node.is_leaf() and node.pos > 0:
+                firstpos[node] = 1 << node.pos
+                lastpos[node] = 1 << node.pos
+            elif node.val == Regex.OP_UNION:
+                firstpos[node] = firstpos[node.left] | firstpos[node.right]
+                lastpos[node] = lastpos[node.left] | lastpos[node.right]
+            elif node.val == Regex.OP_CONCAT:
+                firstpos[node] = firstpos[node.left]
+                if nullable[node.left]:
+                    firstpos[node] |= firstpos[node.right]
+                lastpos[node] = lastpos[node.right]
+                if nullable[node.right]:
+                    lastpos[node] |= lastpos[node.left]
+            elif node.val == Regex.OP_KLEENE:
+                firstpos[node] = firstpos[node.left]
+                lastpos[node] = lastpos[node.left]
+            else:
+                firstpos[node] = 0
+                lastpos[node] = 0
 
-        AST._getTokenPosMap(node.left, tokenPosMap)
-        AST._getTokenPosMap(node.right, tokenPosMap)
+            # Follow positions
+            if node.val == Regex.OP_CONCAT:
+                for i in positions(lastpos[node.left]):
+                    followpos[i] |= firstpos[node.right]
+            elif node.val == Regex.OP_KLEENE:
+                for i in positions(lastpos[node]):
+                    followpos[i] |= firstpos[node]
 
-        if node.pos >= 0:
-            tokenPosMap[node.val].add(node.pos)
+        return (firstpos, lastpos, followpos)
 
     def getTokenPosMap(self):
-        tokenPosMap = defaultdict(set)
-        AST._getTokenPosMap(self.root, tokenPosMap)
+        # Token -> bitmask of its positions
+        tokenPosMap = defaultdict(int)
+        for node in self._postorder():
+            if node.pos >= 0:
+                tokenPosMap[node.val] |= 1 << node.pos
         return tokenPosMap
 
+    def getPosTokenMap(self):
+        # Position -> token (the inverse of getTokenPosMap)
+        posTokenMap = dict()
+        for node in self._postorder():
+            if node.pos >= 0:
+                posTokenMap[node.pos] = node.val
+        return posTokenMap
+
 
 class Regex():
     '''
@@ -148,160 +164,81 @@ class Regex():
     priority = {OP_KLEENE: 3, OP_CONCAT: 2, OP_UNION: 1, OP_END: 0}
     non_terminals = set([OP_KLEENE, OP_CONCAT, OP_UNION, OP_END, '(', ')'])
 
-    def __init__(self, pattern, network):
-        alphabet, drop_alph = Regex.compute_alphabet(network)
-        pattern = Regex.preprocessor(pattern, alphabet, network)
-        tokens = Regex.lexer(pattern, alphabet, drop_alph)
-        self.ast = Regex.parser(tokens, alphabet, drop_alph)
+    def __init__(self, pattern, topo):
+        tokens = Regex.preprocessor(pattern, topo.macros)
+        self.ast = Regex.parser(tokens, topo.alphabet, topo.drop_alph)
 
     @staticmethod
-    def compute_alphabet(network):
-        alphabet = set()
-        for link in network['links']:
-            if link['node1'] not in network['hosts']:
-                alphabet.add(link['node1'] + 'p' + str(link['port1']))
-            if link['node2'] not in network['hosts']:
-                alphabet.add(link['node2'] + 'p' + str(link['port2']))
-        drop_alph = set()
-        for sw_name in network['switches'].keys():
-            drop_alph.add(sw_name + 'd')
-        return alphabet, drop_alph
-
-    @staticmethod
-    def preprocessor(pattern, alphabet, network):
-        pattern = pattern.replace(' ', '')
-
-        def get_union_string(tokens):
-            string = '('
-            for token in tokens:
-                string += (token + Regex.OP_UNION)
-            string = string[:-1] + ')'
-            return string
-
-        while True:
-            i = pattern.find('[^')
-            if i == -1:
-                break
-            j = pattern.find(']', i)
-            tokens = Regex.lexer(pattern[i + 2:j], alphabet)
-            pattern = (pattern[:i] + get_union_string(alphabet - set(tokens)) +
-                       pattern[j + 1:])
-
-        while True:
-            i = pattern.find('[')
-            if i == -1:
-                break
-            j = pattern.find(']', i)
-            tokens = Regex.lexer(pattern[i + 1:j], alphabet)
-            pattern = (pattern[:i] + get_union_string(set(tokens)) +
-                       pattern[j + 1:])
-
-        while True:
-            i = pattern.find('.')
-            if i == -1:
-                break
-            pattern = pattern[:i] + get_union_string(alphabet) + pattern[i + 1:]
-
-        while True:
-            i = pattern.find('out')
-            if i == -1:
-                break
-            outbound = set()
-            for sw_name, sw in network['switches'].items():
-                for hport in sw['host_ports']:
-                    outbound.add(sw_name + 'p' + str(hport))
-            pattern = pattern[:i] + get_union_string(outbound) + pattern[i + 3:]
-
-        def collect_dev_endpoints(device, network):
-            # If the device is a host, or if the device is a switch whose
-            # interface in question is connected to another switch, then
-            # collect the neighboring interfaces as endpoints. Otherwise, if
-            # the device is a switch whose interface in question is
-            # connected to a host, then collect the switch's (entry)
-            # interface as an endpoint.
-            endpoints = set()
-            if device in network['hosts']:
-                dev_type = 'hosts'
-            elif device in network['switches']:
-                dev_type = 'switches'
+    def scan(pattern, macros):
+        """
+        Splits the pattern into its operators and operands, in order. Yields
+        (token, endpoints) pairs: the operators with None, and the operands
+        (endpoints, macros, '[...]' and '[^...]') with the endpoints that they
+        match.
+        """
+        i = 0
+        while i < len(pattern):
+            if pattern[i].isspace():
+                i += 1
+            elif pattern[i] == '[':
+                j = pattern.find(']', i)
+                if j == -1:
+                    raise Exception('Unterminated bracket: ' + pattern[i:])
+                if pattern[i + 1:i + 2] == '^':
+                    endpoints = macros.alphabet - macros.match_set(
+                        pattern, i + 2, j)
+                else:
+                    endpoints = macros.match_set(pattern, i + 1, j)
+                yield pattern[i:j + 1], endpoints
+                i = j + 1
+            elif pattern[i] in Regex.non_terminals:
+                yield pattern[i], None
+                i += 1
             else:
-                raise Exception('Unknown device ' + device)
-            intfs_dict = network[dev_type][device]['intfs']
-            for intf in intfs_dict.values():
-                if 'neighborNode' not in intf:
-                    continue
-                if (dev_type == 'hosts' or
-                        intf['neighborNode'] in network['switches']):
-                    endpoints.add(intf['neighborNode'] + 'p' +
-                                  str(intf['neighborPort']))
+                endpoint, name, i = macros.match(pattern, i)
+                if endpoint is not None:
+                    yield endpoint, set([endpoint])
                 else:
-                    endpoints.add(device + 'p' + str(intf['port']))
-            return endpoints
-
-        # Devices without ports
-        for device in (list(network['hosts'].keys()) +
-                       list(network['switches'].keys())):
-            while True:
-                m = re.search('({})[^p]'.format(device),
-                              pattern,
-                              flags=re.IGNORECASE)
-                if m == None:
-                    break
-                endpoints = collect_dev_endpoints(device, network)
-                pattern = (pattern[:m.start(1)] + get_union_string(endpoints) +
-                           pattern[m.end(1):])
-
-        # Custom groups
-        for gr_name, devices in network['groups'].items():
-            while True:
-                i = pattern.find(gr_name)
-                if i == -1:
-                    break
-                endpoints = set()
-                for device in devices:
-                    endpoints |= collect_dev_endpoints(device, network)
-                pattern = (pattern[:i] + get_union_string(endpoints) +
-                           pattern[i + len(gr_name):])
-
-        return pattern + Regex.OP_END
+                    yield name, macros.sets[name]
 
     @staticmethod
-    def lexer(pattern, alphabet, drop_alph):
-        # Lexical analysis
+    def preprocessor(pattern, macros):
+        # Tokenize the pattern and expand the macros ('.', 'out', devices,
+        # groups, '[...]' and '[^...]') into unions of endpoints in a single
+        # pass
         tokens = list()
-        ep_pattern = re.compile(r's\d+(p\d+|d)', flags=re.IGNORECASE)
-
-        i = 0
-        while i < len(pattern):
-            if pattern[i] in Regex.non_terminals:
-                tokens.append(pattern[i])
-                i += 1
+        for token, endpoints in Regex.scan(pattern, macros):
+            if endpoints is None or token in macros.all_alph:
+                tokens.append(token)
+            elif token in macros.sets:
+                tokens += macros.expansion(token)
             else:
-                m = ep_pattern.match(pattern[i:])
-                if m is None or m.end() == -1:
-                    raise Exception('Invalid pattern: ' + pattern[i:])
-                endpoint = m.group(0)
-                if endpoint not in alphabet.union(drop_alph):
-                    raise Exception(
-                        'Endpoint does not exist or is not connected: ' +
-                        endpoint)
-                tokens.append(endpoint)
-                i += m.end()
-
+                tokens += Macros.union_tokens(sorted(endpoints), token)
+        tokens.append(Regex.OP_END)
         return tokens
 
+    @staticmethod
+    def operand_sets(pattern, macros):
+        "Sets of endpoints matched by the operands of the pattern, in order"
+        return [
+            endpoints for _, endpoints in Regex.scan(pattern, macros)
+            if endpoints is not None
+        ]
+
     @staticmethod
     def parser(tokens, alphabet, drop_alph):
         # Syntax analysis
         all_alph = alphabet.union(drop_alph)
+        operands = all_alph.union(set([Regex.OP_END]))
+        concat_after = all_alph.union(set([Regex.OP_KLEENE, ')']))
+        concat_before = all_alph.union(set([Regex.OP_END, '(']))
 
         # Add concatenation symbols
         prev_token = None
         new_tokens = list()
         for token in tokens:
             if len(token) > 0:
-                if (prev_token in all_alph.union(set([Regex.OP_KLEENE, ')']))
-                        and token in all_alph.union(set([Regex.OP_END, '(']))):
+                if prev_token in concat_after and token in concat_before:
                     new_tokens.append(Regex.OP_CONCAT)
             new_tokens.append(token)
             prev_token = token
@@ -312,7 +249,7 @@ class Regex():
         postfix = list()
         op_stack = list()
         for token in tokens:
-            if token in all_alph.union(set([Regex.OP_END])):
+            if token in operands:
                 postfix.append(token)
             elif token == '(':
                 op_stack.append(token)
@@ -337,3 +274,84 @@ class Regex():
             postfix.append(op_stack.pop())
 
         return AST(postfix, all_alph)
+
+
+class Macros():
+    '''
+    Expansion sets of the pattern macros of a network:
+        '.': Any endpoint
+        'out': Outbound (host-facing) ports
+        Device name: Endpoints of the device
+        Group name: Endpoints of the devices in the group
+    They are computed once per network topology (see Topology) and shared by all
+    the patterns compiled against it.
+    '''
+
+    ep_pattern = re.compile(r's\d+(p\d+|d)', flags=re.IGNORECASE)
+
+    def __init__(self, topo):
+        self.alphabet = topo.alphabet
+        self.all_alph = topo.all_alph
+
+        self.sets = {'.': topo.alphabet, 'out': topo.outbound}
+        for device, endpoints in topo.dev_endpoints.items():
+            self.sets.setdefault(device, endpoints)
+        for gr_name, endpoints in topo.group_endpoints.items():
+            self.sets.setdefault(gr_name, endpoints)
+
+        # Longest names first, so that e.g. h16 is not matched as h1
+        names = sorted(self.sets, key=lambda name: (-len(name), name))
+        self.name_re = re.compile('|'.join(map(re.escape, names)))
+        self.expansions = dict()
+
+    @staticmethod
+    def union_tokens(endpoints, macro):
+        if len(endpoints) == 0:
+            raise Exception('No endpoint matches ' + macro)
+        tokens = ['(']
+        for endpoint in endpoints:
+            tokens.append(endpoint)
+            tokens.append(Regex.OP_UNION)
+        tokens[-1] = ')'
+        return tokens
+
+    def expansion(self, name):
+        tokens = self.expansions.get(name)
+        if tokens is None:
+            tokens = Macros.union_tokens(sorted(self.sets[name]), name)
+            self.expansions[name] = tokens
+        return tokens
+
+    def match(self, pattern, pos, endpos=None):
+        # Match the longest endpoint or macro name at pattern[pos:endpos].
+        # Returns (endpoint, None, end) or (None, macro name, end).
+        if endpos is None:
+            endpos = len(pattern)
+        ep = Macros.ep_pattern.match(pattern, pos, endpos)
+        name = self.name_re.match(pattern, pos, endpos)
+        if name is not None and (ep is None or name.end() > ep.end()):
+            return None, name.group(0), name.end()
+        if ep is None:
+            raise Exception('Invalid pattern: ' + pattern[pos:endpos])
+        # Endpoints may be written in any case, e.g. S1P2 for s1p2
+        endpoint = ep.group(0)
+        if endpoint not in self.all_alph:
+            endpoint = endpoint.lower()
+        if endpoint not in self.all_alph:
+            raise Exception('Endpoint does not exist or is not connected: ' +
+                            ep.group(0))
+        return endpoint, None, ep.end()
+
+    def match_set(self, pattern, pos, endpos):
+        # Endpoints of the macros and endpoints in pattern[pos:endpos]
+        endpoints = set()
+        while pos < endpos:
+            if pattern[pos].isspace():
+                pos += 1
+                continue
+            endpoint, name, pos = self.match(pattern, pos, endpos)
+            if endpoint is not None:
+                endpoints.add(endpoint)
+            else:
+                endpoints |= self.sets[name]
+        return endpoints
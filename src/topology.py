@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import json
+import hashlib
+
+from .regex import Macros
+
+
+class Topology:
+    """
+    Index of the network topology, built once when the network is loaded and
+    shared by all the compiler stages (regex macro expansion, DFA construction
+    and optimization, and rule generation), so that none of them rescans the
+    network dict.
+
+    The symbols are the connected switch ports 'sNpM' and the drop symbols
+    'sNd'. Each symbol is interned to an integer ID, which indexes the sym_*
+    arrays: the switch, the port (None for drop symbols) and the neighboring
+    node (None if not connected).
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.hosts = set(network['hosts'].keys())
+        self.switches = list(network['switches'].keys())
+        self.border_switches = [
+            sw_name for sw_name, sw in network['switches'].items()
+            if len(sw['host_ports']) > 0
+        ]
+        self.outbound = set()
+        for sw_name, sw in network['switches'].items():
+            for hport in sw['host_ports']:
+                self.outbound.add(sw_name + 'p' + str(hport))
+
+        # Alphabet
+        ports = dict() # symbol -> (switch, port, neighbor)
+        for link in network['links']:
+            for node, port, neighbor in [
+                (link['node1'], link['port1'], link['node2']),
+                (link['node2'], link['port2'], link['node1']),
+            ]:
+                if node not in self.hosts:
+                    ports[node + 'p' + str(port)] = (node, port, neighbor)
+        self.alphabet = set(ports.keys())
+        self.drop_alph = set(sw_name + 'd' for sw_name in self.switches)
+        self.all_alph = self.alphabet | self.drop_alph
+
+        # Interned symbols
+        self.symbols = sorted(self.alphabet) + sorted(self.drop_alph)
+        self.symbol_ids = {sym: i for i, sym in enumerate(self.symbols)}
+        self.sym_switch = []
+        self.sym_port = []
+        self.sym_neighbor = []
+        for sym in self.symbols:
+            if sym in ports:
+                sw_name, port, neighbor = ports[sym]
+            else:
+                sw_name, port, neighbor = sym[:-1], None, None
+            self.sym_switch.append(sw_name)
+            self.sym_port.append(port)
+            self.sym_neighbor.append(neighbor)
+
+        # Per-device symbols
+        self.dev_ports = dict() # switch -> { connected port symbols }
+        self.dev_endpoints = dict() # device -> { endpoints }
+        for device in network['hosts']:
+            self._add_device(device, 'hosts')
+        for device in network['switches']:
+            self._add_device(device, 'switches')
+        self.group_endpoints = dict() # group -> { endpoints }
+        for gr_name, devices in network['groups'].items():
+            endpoints = set()
+            for device in devices:
+                if device not in self.dev_endpoints:
+                    raise Exception('Unknown device ' + device)
+                endpoints |= self.dev_endpoints[device]
+            self.group_endpoints[gr_name] = endpoints
+
+        self.fingerprint = self._fingerprint()
+        self.macros = Macros(self)
+
+    def _add_device(self, device, dev_type):
+        # If the device is a host, or if the device is a switch whose interface
+        # in question is connected to another switch, then collect the
+        # neighboring interfaces as endpoints. Otherwise, if the device is a
+        # switch whose interface in question is connected to a host, then
+        # collect the switch's (entry) interface as an endpoint.
+        ports = set()
+        endpoints = set()
+        for intf in self.network[dev_type][device]['intfs'].values():
+            if 'neighborNode' not in intf:
+                continue
+            if dev_type == 'switches':
+                ports.add(device + 'p' + str(intf['port']))
+            if (dev_type == 'hosts' or
+                    intf['neighborNode'] in self.network['switches']):
+                endpoints.add(intf['neighborNode'] + 'p' +
+                              str(intf['neighborPort']))
+            else:
+                endpoints.add(device + 'p' + str(intf['port']))
+        if dev_type == 'switches':
+            self.dev_ports[device] = ports
+        self.dev_endpoints[device] = endpoints
+
+    def _fingerprint(self):
+        # Digest of the parts of the network that the compiled DFAs depend on
+        links = [
+            json.dumps(link, sort_keys=True) for link in self.network['links']
+        ]
+        content = {
+            'links': sorted(links),
+            'host_ports': {
+                sw_name: sorted(sw['host_ports'])
+                for sw_name, sw in self.network['switches'].items()
+            },
+            'groups': {
+                gr_name: sorted(devices)
+                for gr_name, devices in self.network['groups'].items()
+            },
+            'symbols': self.symbols,
+        }
+        content = json.dumps(content, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def is_border(self, sw_name):
+        return len(self.network['switches'][sw_name]['host_ports']) > 0
+
+    def changed_symbols(self, other):
+        "Symbols that are missing in, added to or connected differently in other"
+        links = dict(
+            zip(self.symbols,
+                zip(self.sym_switch, self.sym_port, self.sym_neighbor)))
+        other_links = dict(
+            zip(other.symbols,
+                zip(other.sym_switch, other.sym_port, other.sym_neighbor)))
+        return set(sym for sym in links.keys() | other_links.keys()
+                   if links.get(sym) != other_links.get(sym))
+
+    def is_restriction_of(self, base, added=frozenset()):
+        """
+        Whether every macro of this topology expands to the endpoints of its
+        expansion in the base topology that are still in the alphabet, e.g., when
+        links of the base topology are down. A DFA constructed on the base
+        topology then only needs its transitions on the missing symbols pruned.
+        The added symbols (e.g., of new ports), which are not in the base
+        topology, are left to the caller (see RegexInvariant.update_topology).
+        """
+        if not self.all_alph <= base.all_alph | added:
+            return False
+        if self.macros.sets.keys() != base.macros.sets.keys():
+            return False
+        # Endpoints that are not in the alphabet never match a valid input
+        symbols = self.all_alph - added
+        for name, endpoints in self.macros.sets.items():
+            if endpoints & symbols != base.macros.sets[name] & symbols:
+                return False
+        return True
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import json
+import ipaddress
+from collections import namedtuple, deque, Counter
+
+from .constants import *
+from .packetin import PacketInHeaders
+
+
+class Violation(
+        namedtuple('Violation', [
+            'switch', 'inv_id', 'src_ip', 'dst_ip', 'proto', 'src_port',
+            'dst_port', 'timestamp', 'headers'
+        ])):
+    """
+    Compact record of a violating packet reported by a switch. The addresses
+    are 32-bit integers, and the fields that the packet does not carry (e.g.,
+    the ports of an ICMP packet) are 0. The headers (PacketInHeaders) give
+    access to the whole packet.
+    """
+
+    __slots__ = ()
+
+    @property
+    def flow(self):
+        return (self.src_ip, self.dst_ip, self.proto, self.src_port,
+                self.dst_port)
+
+
+class ViolationReport(
+        namedtuple('ViolationReport', [
+            'switch', 'inv_id', 'flow', 'count', 'first_seen', 'last_seen',
+            'headers'
+        ])):
+    """
+    Violations of an invariant at a switch by the packets of a flow, aggregated
+    over (a part of) a window. The first violation of each window is reported
+    on its own (count 1), and the following ones are reported at the end of the
+    window. The headers are those of the first reported packet.
+    """
+
+    __slots__ = ()
+
+    def to_dict(self):
+        src_ip, dst_ip, proto, src_port, dst_port = self.flow
+        return {
+            'switch': self.switch,
+            'invariant': self.inv_id,
+            'src_ip': str(ipaddress.IPv4Address(src_ip)),
+            'dst_ip': str(ipaddress.IPv4Address(dst_ip)),
+            'proto': proto,
+            'src_port': src_port,
+            'dst_port': dst_port,
+            'count': self.count,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen
+        }
+
+
+def decode_packet_in(sw_name, packet, timestamp):
+    "Decodes a PacketIn message into a Violation"
+    inv_id = int.from_bytes(packet.metadata[0].value, byteorder='big')
+    headers = PacketInHeaders(packet.payload)
+    return Violation(sw_name, inv_id, headers.src_ip, headers.dst_ip,
+                     headers.proto, headers.src_port, headers.dst_port,
+                     timestamp, headers)
+
+
+class RateLimiter:
+    """
+    Token bucket per invariant: up to `burst` reports at once, refilled at
+    `rate` reports per second. A rate of None disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst != None else rate
+        self.buckets = dict() # invariant ID -> [ tokens, last refill time ]
+
+    def allow(self, inv_id, now):
+        if self.rate == None:
+            return True
+        bucket = self.buckets.get(inv_id)
+        if bucket == None:
+            bucket = [self.burst, now]
+            self.buckets[inv_id] = bucket
+        else:
+            elapsed = max(now - bucket[1], 0)
+            bucket[0] = min(self.burst, bucket[0] + elapsed * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+class ViolationPipeline:
+    """
+    Aggregates the violations per (invariant, switch, flow) over windows of
+    `window` seconds, rate-limits the resulting reports per invariant and
+    writes them to the sinks. A sink is any object with emit(report), flush()
+    and close() methods.
+    """
+
+    def __init__(self,
+                 sinks,
+                 window=VIOLATION_WINDOW,
+                 rate=VIOLATION_RATE,
+                 burst=None,
+                 max_flows=VIOLATION_MAX_FLOWS):
+        self.sinks = list(sinks)
+        self.window = window
+        self.limiter = RateLimiter(rate, burst)
+        self.max_flows = max_flows # flows aggregated before an early flush
+        self.window_end = None
+        # (invariant ID, switch, flow) -> [ count, first seen, last seen,
+        # headers ] of the violations not yet reported in this window
+        self.pending = dict()
+        self.received = 0
+        self.dropped = Counter() # invariant ID -> reports dropped by the limit
+
+    def process(self, violation):
+        now = violation.timestamp
+        if self.window_end == None:
+            self.window_end = now + self.window
+        elif now >= self.window_end or len(self.pending) >= self.max_flows:
+            self.flush(now)
+        self.received += 1
+
+        key = (violation.inv_id, violation.switch, violation.flow)
+        entry = self.pending.get(key)
+        if entry != None:
+            if entry[0] == 0:
+                entry[1] = now
+                entry[3] = violation.headers
+            entry[0] += 1
+            entry[2] = now
+            return
+        # The first violation of the flow in this window is reported at once
+        self.pending[key] = [0, None, None, None]
+        self._report(key, 1, now, now, violation.headers, now)
+
+    def flush(self, now):
+        "Reports the pending aggregated violations, and starts a new window"
+        pending = self.pending
+        self.pending = dict()
+        self.window_end = now + self.window
+        for key, (count, first_seen, last_seen, headers) in pending.items():
+            if count > 0:
+                self._report(key, count, first_seen, last_seen, headers, now)
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self, now):
+        self.flush(now)
+        for sink in self.sinks:
+            sink.close()
+
+    def _report(self, key, count, first_seen, last_seen, headers, now):
+        inv_id, switch, flow = key
+        if not self.limiter.allow(inv_id, now):
+            self.dropped[inv_id] += count
+            return
+        report = ViolationReport(switch, inv_id, flow, count, first_seen,
+                                 last_seen, headers)
+        for sink in self.sinks:
+            sink.emit(report)
+
+
+class PrintSink:
+    """
+    Prints the violation reports with their invariants (invariant ID ->
+    Invariant), and with details, the decoded packet
+    """
+
+    def __init__(self, invariants, details=False):
+        self.invariants = invariants
+        self.details = details
+
+    def emit(self, report):
+        print('Violation occurred at', report.switch)
+        print('Violated invariant:')
+        invariant = self.invariants.get(report.inv_id)
+        if invariant != None:
+            print(invariant)
+        else:
+            print('Unknown invariant', report.inv_id)
+        fields = report.to_dict()
+        print('Flow: {}:{} -> {}:{}, protocol {}'.format(
+            fields['src_ip'], fields['src_port'], fields['dst_ip'],
+            fields['dst_port'], fields['proto']))
+        if report.count > 1:
+            print('Repeated {} times in {:.3f} seconds'.format(
+                report.count, report.last_seen - report.first_seen))
+        if self.details:
+            print(report.headers.ethernet())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    "Appends the violation reports to a file, one JSON object per line"
+
+    def __init__(self, path):
+        self.outfile = open(path, 'a')
+
+    def emit(self, report):
+        self.outfile.write(json.dumps(report.to_dict()) + '\n')
+
+    def flush(self):
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+
+class RingBufferSink:
+    "Keeps the latest violation reports in memory"
+
+    def __init__(self, size=VIOLATION_RING_SIZE):
+        self.buffer = deque(maxlen=size)
+
+    def emit(self, report):
+        self.buffer.append(report)
+
+    def reports(self):
+        return list(self.buffer)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass